@@ -4,4 +4,5 @@ from .boolean_expression import (BooleanConstant, BooleanExpression,
                                 BooleanExpressionAnd,
                                 BooleanExpressionException,
                                 BooleanExpressionMulti, BooleanExpressionNot,
-                                BooleanExpressionOr, BooleanVar)
+                                BooleanExpressionOr, BooleanVar,
+                                BooleanVarIdx)
@@ -1,7 +1,10 @@
 # (c) Andrew Chen (https://github.com/achen1296)
 
+import functools
 import itertools
+import operator
 import re
+import sys
 from abc import ABC, abstractmethod
 from typing import Callable, Iterable, Literal
 
@@ -11,11 +14,113 @@ class BooleanExpressionException(Exception):
 
 
 class BooleanExpression(ABC):
+    # subclasses use __slots__ to keep nodes small, this must be empty so that they don't get a __dict__ anyway
+    __slots__ = ()
+
+    def evaluate(self, vars: Iterable[str] | int) -> bool:
+        """ vars is an iterable of variables that are true, the rest are false implicitly. It is converted to a frozenset once here (unless it is already a set) so that each variable lookup in the tree is O(1).
+
+        For an expression returned by `prepare`, vars is instead an int bit mask from `var_mask`. """
+        if not isinstance(vars, (set, frozenset, int)):
+            vars = frozenset(vars)
+        return self._match(vars)
+
+    def match(self, vars: Iterable[str] | int) -> bool:
+        """ Same as `evaluate`. """
+        return self.evaluate(vars)
+
+    def evaluate_fast(self, vars: Iterable[str]) -> bool:
+        """ Same as `evaluate`, but interns the variable names first, like the variable names in compiled expressions. Lookups can then compare strings by identity instead of by value. It is even faster to intern the names once and reuse the set for many evaluations. """
+        return self._match(frozenset(map(sys.intern, vars)))
+
     @abstractmethod
-    def match(self, vars: Iterable[str]) -> bool:
-        """ vars is an iterable of variables that are true, the rest are false implicitly """
+    def _match(self, vars: set[str] | frozenset[str]) -> bool:
+        """ Recursive implementation of `evaluate`, vars has already been converted to a set. """
         pass
 
+    def index(self, var_ids: dict[str, int]) -> "BooleanExpression":
+        """ Return a copy of this expression with each `BooleanVar` replaced by a `BooleanVarIdx`. Variables not already in var_ids are added to it with the next unused index. """
+        # a custom node (like a compiled_var result) would be passed the int bit mask instead of a set
+        raise BooleanExpressionException(
+            f"{type(self).__name__} cannot be indexed")
+
+    def prepare(self) -> tuple["BooleanExpression", dict[str, int]]:
+        """ Index all variables, see `index`. Useful when evaluating the same expression many times, since testing a bit is faster than looking up a string in a set. Use `var_mask` to convert each set of true variables for the returned expression. """
+        var_ids = {}
+        return self.index(var_ids), var_ids
+
+    @staticmethod
+    def var_mask(var_ids: dict[str, int], vars: Iterable[str]) -> int:
+        """ Bit mask of the true variables for an expression from `prepare`. Variables not in the expression are ignored. """
+        mask = 0
+        for v in vars:
+            if v in var_ids:
+                mask |= 1 << var_ids[v]
+        return mask
+
+    def compile_bytecode(self) -> list[tuple]:
+        """ Flatten the expression into a list of instructions for `execute`, which evaluates it in a single loop instead of one method call per node. Jump offsets are relative, so the code for a sub-expression can be embedded as-is.
+
+        The default is to call `_match` on this expression, which subclasses like a custom `compiled_var` can rely on. """
+        return [("CALL", self)]
+
+    def to_python_source(self) -> str:
+        """ Python expression equivalent to this expression, in terms of the set of true variables `V`. """
+        raise BooleanExpressionException(
+            f"{type(self).__name__} cannot be converted to Python source")
+
+    def to_callable(self) -> Callable[[set[str] | frozenset[str]], bool]:
+        """ Compile `to_python_source` into a function, which evaluates the whole expression as Python bytecode without any method calls. Pass it a set or frozenset of the true variables (or an int bit mask for an expression from `prepare`). """
+        try:
+            return eval("lambda V: " + self.to_python_source(), {})
+        except (MemoryError, SyntaxError, RecursionError):
+            # nested too deeply for the Python parser or compiler, evaluate takes the same argument
+            return self.evaluate
+
+    @staticmethod
+    def execute(code: list[tuple], vars: Iterable[str] | int) -> bool:
+        """ Run code from `compile_bytecode`. vars is the same as for `evaluate`, including an int bit mask for code from an expression returned by `prepare`. """
+        if not isinstance(vars, (set, frozenset, int)):
+            vars = frozenset(vars)
+        # every instruction sets or tests a single accumulator, jumps skip the given number of following instructions
+        acc = False
+        pc = 0
+        end = len(code)
+        while pc < end:
+            instruction = code[pc]
+            op = instruction[0]
+            if op == "PVAR_JMP_FALSE":
+                acc = instruction[1] in vars
+                if not acc:
+                    pc += instruction[2]
+            elif op == "PVAR_JMP_TRUE":
+                acc = instruction[1] in vars
+                if acc:
+                    pc += instruction[2]
+            elif op == "PVAR":
+                acc = instruction[1] in vars
+            elif op == "PBIT":
+                acc = bool(vars & instruction[1])
+            elif op == "PVAR_NOT":
+                acc = instruction[1] not in vars
+            elif op == "JMP_FALSE":
+                if not acc:
+                    pc += instruction[1]
+            elif op == "JMP_TRUE":
+                if acc:
+                    pc += instruction[1]
+            elif op == "NOT":
+                acc = not acc
+            elif op == "PC":
+                acc = instruction[1]
+            elif op == "CALL":
+                acc = instruction[1]._match(vars)
+            else:
+                raise BooleanExpressionException(
+                    f"Unknown bytecode instruction {instruction}")
+            pc += 1
+        return acc
+
     DEFAULT_GROUP_PAIRS = {"[": "]"}
     DEFAULT_NOT_CHARS = "!"
     DEFAULT_AND_CHARS = "&"
@@ -37,35 +142,45 @@ class BooleanExpression(ABC):
                  string_pairs: dict[str, str] = DEFAULT_STRING_PAIRS,
                  ):
 
-        all_operators = list(itertools.chain(
-            group_pairs.keys(), group_pairs.values(), not_chars, and_chars, or_chars))
+        pattern = BooleanExpression._token_pattern(tuple(group_pairs.items()), not_chars, and_chars, or_chars, tuple(string_pairs.items()))
 
         tokens: list[str] = []
-        t = ""
-        end_quote = None
-        for i in range(0, len(expression)):
-            c = expression[i]
-            if end_quote is not None:
-                if c == end_quote:
-                    end_quote = None
-                else:
-                    t += c
+        # parts of the current token, quoted strings directly next to other text are joined with it
+        parts: list[str] = []
+        for m in pattern.finditer(expression):
+            kind = m.lastgroup
+            if kind == "word":
+                parts.append(m.group())
+            elif kind == "op" or kind == "space":
+                tokens.append("".join(parts))
+                parts = []
+                if kind == "op":
+                    tokens.append(m.group())
             else:
-                if c in string_pairs:
-                    end_quote = string_pairs[c]
-                elif c in all_operators:
-                    tokens.append(t)
-                    t = ""
-                    tokens.append(c)
-                elif c.isspace():
-                    tokens.append(t)
-                    t = ""
-                else:
-                    t += c
-        tokens.append(t)
-        # print(tokens)
+                # string content
+                parts.append(m.group(kind))
+        tokens.append("".join(parts))
         return [t for t in tokens if t != ""]
 
+    @staticmethod
+    @functools.lru_cache
+    def _token_pattern(group_pairs: tuple[tuple[str, str], ...], not_chars: str, and_chars: str, or_chars: str, string_pairs: tuple[tuple[str, str], ...]) -> re.Pattern:
+        operators = "".join(itertools.chain(
+            (start for start, _ in group_pairs), (end for _, end in group_pairs), not_chars, and_chars, or_chars))
+        string_starts = "".join(start for start, _ in string_pairs)
+
+        alternatives = []
+        # string starts take priority over operators, and an unclosed string continues to the end
+        for i, (start, end) in enumerate(string_pairs):
+            alternatives.append(
+                f"{re.escape(start)}(?P<s{i}>[^{re.escape(end)}]*){re.escape(end)}?")
+        if operators:
+            alternatives.append(f"(?P<op>[{re.escape(operators)}])")
+        alternatives.append(r"(?P<space>\s+)")
+        alternatives.append(
+            f"(?P<word>[^{re.escape(operators + string_starts)}\\s]+)")
+        return re.compile("|".join(alternatives))
+
     @staticmethod
     def compile(
         expression: str | list[str],
@@ -101,14 +216,40 @@ class BooleanExpression(ABC):
 
         This means that either and or or can be made higher priority all the time by only ever using one of them explicitly.
 
-        `compiled_var` is `BooleanVar` by default, but you can slot in another subclass of `BooleanExpression` to be used in its place with different matching behavior than string comparison.
+        `compiled_var` is `BooleanVar` by default, but you can slot in another subclass of `BooleanExpression` (implementing `_match`) to be used in its place with different matching behavior than string comparison.
+
+        Results of compiling a string are cached, so the same expression object may be returned for repeated calls and must not be modified.
         """
 
         compiled_var = compiled_var or BooleanVar  # cannot refer to this at function definition time
 
-        all_operators = list(itertools.chain(
-            group_pairs.keys(), group_pairs.values(), not_chars, and_chars, or_chars))
-        binary_operators = and_chars + or_chars
+        if isinstance(expression, str):
+            # dicts/lists are not hashable, convert to tuples for the cache
+            return BooleanExpression._compile_cached(expression, tuple(true_names), tuple(false_names), tuple(group_pairs.items()), not_chars, and_chars, or_chars, tuple(string_pairs.items()), implicit_binary, compiled_var)
+        else:
+            # already tokenized, not cached
+            return BooleanExpression._compile_uncached(expression, true_names, false_names, group_pairs, not_chars, and_chars, or_chars, string_pairs, implicit_binary, compiled_var)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _compile_cached(expression: str, true_names: tuple[str | re.Pattern, ...], false_names: tuple[str | re.Pattern, ...], group_pairs: tuple[tuple[str, str], ...], not_chars: str, and_chars: str, or_chars: str, string_pairs: tuple[tuple[str, str], ...], implicit_binary: Literal['or'] | Literal['and'] | None, compiled_var: Callable[[str], "BooleanExpression"]):
+        return BooleanExpression._compile_uncached(expression, true_names, false_names, dict(group_pairs), not_chars, and_chars, or_chars, dict(string_pairs), implicit_binary, compiled_var)
+
+    @staticmethod
+    def _compile_uncached(expression: str | list[str], true_names: Iterable[str | re.Pattern], false_names: Iterable[str | re.Pattern], group_pairs: dict[str, str], not_chars: str, and_chars: str, or_chars: str, string_pairs: dict[str, str], implicit_binary: Literal['or'] | Literal['and'] | None, compiled_var: Callable[[str], "BooleanExpression"]):
+
+        # sets for O(1) token classification
+        or_set = frozenset(or_chars)
+        and_set = frozenset(and_chars)
+        not_set = frozenset(not_chars)
+        group_starts = frozenset(group_pairs)
+        binary_operators = or_set | and_set
+        all_operators = binary_operators | not_set | group_starts | frozenset(
+            group_pairs.values())
+
+        # compile once instead of going through the re module cache for every token (re.compile returns Pattern objects as-is)
+        true_patterns = tuple(re.compile(tn) for tn in true_names)
+        false_patterns = tuple(re.compile(fn) for fn in false_names)
 
         implicit_operator_cls = BooleanExpressionOr if implicit_binary == "or" else BooleanExpressionAnd
 
@@ -138,10 +279,10 @@ class BooleanExpression(ABC):
                 t = tokens[i]
                 if t == group_end:
                     return left, i + 1
-                if t in or_chars:
+                if t in or_set:
                     right, i = _consume_implicit(i+1, group_end)
                     operator = BooleanExpressionOr
-                elif t in and_chars:
+                elif t in and_set:
                     right, i = _consume_implicit(i+1, group_end)
                     operator = BooleanExpressionAnd
                 else:
@@ -168,20 +309,21 @@ class BooleanExpression(ABC):
 
         def _compile_unary(i: int) -> tuple[BooleanExpression, int]:
             t = tokens[i]
-            if t in not_chars:
+            if t in not_set:
                 e, i = _compile_unary(i + 1)
-                return BooleanExpressionNot(e), i
-            elif t in group_pairs:
+                return BooleanExpressionNot.create(e), i
+            elif t in group_starts:
                 return _compile(i+1, group_pairs[t])
             else:
                 assert t not in all_operators, t
-                for tn in true_names:
-                    if re.fullmatch(tn, t):
+                for tp in true_patterns:
+                    if tp.fullmatch(t):
                         return BooleanConstant(True), i+1
-                for fn in false_names:
-                    if re.fullmatch(fn, t):
+                for fp in false_patterns:
+                    if fp.fullmatch(t):
                         return BooleanConstant(False), i+1
-                return compiled_var(t), i+1
+                # interned so that set lookups with interned names can compare by identity
+                return compiled_var(sys.intern(t)), i+1
 
         e, i = _compile(0, end_char)
         if i < len(tokens):
@@ -191,12 +333,23 @@ class BooleanExpression(ABC):
 
 
 class BooleanConstant(BooleanExpression):
+    __slots__ = ("value",)
+
     def __init__(self, value: bool):
         self.value = value
 
-    def match(self, vars: Iterable[str]):
+    def _match(self, vars: set[str] | frozenset[str]):
         return self.value
 
+    def index(self, var_ids: dict[str, int]):
+        return self
+
+    def compile_bytecode(self):
+        return [("PC", self.value)]
+
+    def to_python_source(self):
+        return repr(self.value)
+
     def __repr__(self):
         return f"BooleanConstant({self.value})"
 
@@ -205,12 +358,23 @@ class BooleanConstant(BooleanExpression):
 
 
 class BooleanVar(BooleanExpression):
+    __slots__ = ("var",)
+
     def __init__(self, var: str):
         self.var = var
 
-    def match(self, vars: Iterable[str]):
+    def _match(self, vars: set[str] | frozenset[str]):
         return self.var in vars
 
+    def compile_bytecode(self):
+        return [("PVAR", self.var)]
+
+    def to_python_source(self):
+        return f"({self.var!r} in V)"
+
+    def index(self, var_ids: dict[str, int]):
+        return BooleanVarIdx(var_ids.setdefault(self.var, len(var_ids)))
+
     def __repr__(self):
         return "BooleanVar(\""+self.var+"\")"
 
@@ -218,12 +382,64 @@ class BooleanVar(BooleanExpression):
         return isinstance(other, BooleanVar) and self.var == other.var
 
 
+class BooleanVarIdx(BooleanExpression):
+    """ Variable identified by its index in a bit mask, see `BooleanExpression.prepare`. """
+
+    __slots__ = ("idx", "bit")
+
+    def __init__(self, idx: int):
+        self.idx = idx
+        self.bit = 1 << idx
+
+    def _match(self, vars: int):
+        return bool(vars & self.bit)
+
+    def index(self, var_ids: dict[str, int]):
+        # already indexed
+        return self
+
+    def compile_bytecode(self):
+        return [("PBIT", self.bit)]
+
+    def to_python_source(self):
+        return f"bool(V & {self.bit})"
+
+    def __repr__(self):
+        return f"BooleanVarIdx({self.idx})"
+
+    def __eq__(self, other):
+        return isinstance(other, BooleanVarIdx) and self.idx == other.idx
+
+
 class BooleanExpressionNot(BooleanExpression):
+    __slots__ = ("sub_expression",)
+
     def __init__(self, sub_expression: BooleanExpression):
         self.sub_expression = sub_expression
 
-    def match(self, vars: Iterable[str]):
-        return not self.sub_expression.match(vars)
+    @classmethod
+    def create(cls, sub_expression: BooleanExpression):
+        if isinstance(sub_expression, BooleanConstant):
+            return BooleanConstant(not sub_expression.value)
+        if isinstance(sub_expression, BooleanExpressionNot):
+            return sub_expression.sub_expression
+        return cls(sub_expression)
+
+    def _match(self, vars: set[str] | frozenset[str]):
+        return not self.sub_expression._match(vars)
+
+    def index(self, var_ids: dict[str, int]):
+        return BooleanExpressionNot(self.sub_expression.index(var_ids))
+
+    def compile_bytecode(self):
+        code = self.sub_expression.compile_bytecode()
+        if len(code) == 1 and code[0][0] == "PVAR":
+            # fused instruction
+            return [("PVAR_NOT", code[0][1])]
+        return code + [("NOT",)]
+
+    def to_python_source(self):
+        return f"(not {self.sub_expression.to_python_source()})"
 
     def __repr__(self):
         return "BooleanExpressionNot("+repr(self.sub_expression)+")"
@@ -232,14 +448,77 @@ class BooleanExpressionNot(BooleanExpression):
         return isinstance(other, BooleanExpressionNot) and self.sub_expression == other.sub_expression
 
 
+def _depth(e: BooleanExpression) -> int:
+    if isinstance(e, BooleanExpressionMulti):
+        return 1 + max((_depth(sub) for sub in e.sub_expressions), default=0)
+    if isinstance(e, BooleanExpressionNot):
+        return 1 + _depth(e.sub_expression)
+    # BooleanVar, BooleanConstant, or a custom compiled_var
+    return 0
+
+
 class BooleanExpressionMulti(BooleanExpression):
+    __slots__ = ("sub_expressions", "_eval_order")
+
+    # evaluate shallow sub-expressions before deep ones so that short-circuiting skips as much as possible
+    REORDER = True
+    # value of a sub-expression that decides the result of the whole expression by itself
+    SHORT_CIRCUIT_VALUE: bool
+
     def __init__(self, *sub_expressions: BooleanExpression):
+        # original order is kept for repr/eq, _eval_order is only used by _match
         self.sub_expressions = sub_expressions
+        if self.REORDER:
+            self._eval_order = tuple(sorted(sub_expressions, key=self._eval_key))
+        else:
+            self._eval_order = sub_expressions
+
+    def _eval_key(self, e: BooleanExpression) -> int:
+        if isinstance(e, BooleanConstant) and e.value == self.SHORT_CIRCUIT_VALUE:
+            return -1
+        return _depth(e)
+
+    def index(self, var_ids: dict[str, int]):
+        return type(self)(*(sub.index(var_ids) for sub in self.sub_expressions))
+
+    def compile_bytecode(self):
+        if not self._eval_order:
+            return [("PC", not self.SHORT_CIRCUIT_VALUE)]
+        jump = "JMP_TRUE" if self.SHORT_CIRCUIT_VALUE else "JMP_FALSE"
+        code = []
+        # indices of jumps to the end, patched once the total length is known
+        jumps = []
+        for sub in self._eval_order[:-1]:
+            sub_code = sub.compile_bytecode()
+            if len(sub_code) == 1 and sub_code[0][0] == "PVAR":
+                # fused instruction
+                code.append(("PVAR_" + jump, sub_code[0][1]))
+            else:
+                code.extend(sub_code)
+                code.append((jump,))
+            jumps.append(len(code) - 1)
+        code.extend(self._eval_order[-1].compile_bytecode())
+        for j in jumps:
+            code[j] = code[j] + (len(code) - j - 1,)
+        return code
+
+    def to_python_source(self):
+        if not self._eval_order:
+            return repr(not self.SHORT_CIRCUIT_VALUE)
+        op = " or " if self.SHORT_CIRCUIT_VALUE else " and "
+        return "(" + op.join(sub.to_python_source() for sub in self._eval_order) + ")"
 
     @classmethod
     def create(cls, *sub_expressions: BooleanExpression):
+        # fold constants: one short-circuiting constant decides the whole expression, the others have no effect
+        if any(isinstance(sub, BooleanConstant) and sub.value == cls.SHORT_CIRCUIT_VALUE for sub in sub_expressions):
+            return BooleanConstant(cls.SHORT_CIRCUIT_VALUE)
+        sub_expressions = tuple(
+            sub for sub in sub_expressions if not isinstance(sub, BooleanConstant))
+        # With no sub-expressions left, and is always true and or is always false.
+        if len(sub_expressions) == 0:
+            return BooleanConstant(not cls.SHORT_CIRCUIT_VALUE)
         # For and/or, it would be useless to wrap a single expression.
-        # On the other hand, wrapping an empty list actually does something different -- for and, it will be always false, and for or, always true.
         if len(sub_expressions) == 1:
             return sub_expressions[0]
         if all(isinstance(sub, cls) for sub in sub_expressions):
@@ -249,8 +528,13 @@ class BooleanExpressionMulti(BooleanExpression):
 
 
 class BooleanExpressionAnd(BooleanExpressionMulti):
-    def match(self, vars: Iterable[str]):
-        return all(sub.match(vars) for sub in self.sub_expressions)
+    __slots__ = ()
+
+    SHORT_CIRCUIT_VALUE = False
+
+    def _match(self, vars: set[str] | frozenset[str]):
+        # map with methodcaller avoids creating a generator frame
+        return all(map(operator.methodcaller("_match", vars), self._eval_order))
 
     def __repr__(self):
         return "BooleanExpressionAnd("+", ".join((repr(sub) for sub in self.sub_expressions))+")"
@@ -265,8 +549,13 @@ class BooleanExpressionAnd(BooleanExpressionMulti):
 
 
 class BooleanExpressionOr(BooleanExpressionMulti):
-    def match(self, vars: Iterable[str]):
-        return any(sub.match(vars) for sub in self.sub_expressions)
+    __slots__ = ()
+
+    SHORT_CIRCUIT_VALUE = True
+
+    def _match(self, vars: set[str] | frozenset[str]):
+        # map with methodcaller avoids creating a generator frame
+        return any(map(operator.methodcaller("_match", vars), self._eval_order))
 
     def __repr__(self):
         return "BooleanExpressionOr("+", ".join((repr(sub) for sub in self.sub_expressions))+")"
@@ -327,3 +616,65 @@ if __name__ == "__main__":
     assert result.match(["a"])
     assert result.match(["e"])
     assert not result.match(["b", "d"])
+    assert result.evaluate({"a"})
+    assert not result.evaluate(frozenset(["b", "d"]))
+    result = BooleanExpression.compile("a & false | b")
+    assert result == BooleanVar("b"), result
+    result = BooleanExpression.compile("a true & !!b")
+    assert result == BooleanVar("b"), result
+    result = BooleanExpression.compile("![a & true]")
+    assert result == BooleanExpressionNot(BooleanVar("a")), result
+    assert BooleanExpression.compile(
+        "a b") is BooleanExpression.compile("a b")
+    assert BooleanExpression.compile(
+        "a b") is not BooleanExpression.compile("a b", implicit_binary="and")
+    assert BooleanExpression.tokenize(
+        "a'b c'd ''[\"e\"&f") == ["ab cd", "[", "e", "&", "f"]
+    assert BooleanExpression.tokenize("a 'b c") == ["a", "b c"]
+    result = BooleanExpression.compile(
+        "yes no", true_names=["yes"], false_names=[re.compile("no")])
+    assert result == BooleanConstant(True), result
+    result = BooleanExpression.compile("a [!b ![!c&d] e]")
+    code = result.compile_bytecode()
+    for vars in [[], ["a"], ["b"], ["c"], ["d"], ["e"], ["b", "d"], ["b", "c", "d"], ["b", "c"]]:
+        assert BooleanExpression.execute(
+            code, vars) == result.evaluate(vars), (vars, code)
+    result = BooleanExpression.compile("a [!b ![!c&d] e]")
+    indexed, var_ids = result.prepare()
+    assert var_ids == {"a": 0, "b": 1, "c": 2, "d": 3, "e": 4}, var_ids
+    for vars in [[], ["a"], ["b"], ["c"], ["d"], ["e"], ["b", "d"], ["b", "c", "d"], ["b", "c", "x"]]:
+        assert indexed.match(BooleanExpression.var_mask(
+            var_ids, vars)) == result.match(vars), vars
+    indexed_code = indexed.compile_bytecode()
+    for vars in [[], ["a"], ["b"], ["c"], ["d"], ["e"], ["b", "d"], ["b", "c", "d"], ["b", "c", "x"]]:
+        assert BooleanExpression.execute(indexed_code, BooleanExpression.var_mask(
+            var_ids, vars)) == result.match(vars), (vars, indexed_code)
+    assert result.evaluate_fast(["e"])
+    f = result.to_callable()
+    indexed_f = indexed.to_callable()
+    for vars in [[], ["a"], ["b"], ["c"], ["d"], ["e"], ["b", "d"], ["b", "c", "d"], ["b", "c", "x"]]:
+        assert f(set(vars)) == result.match(vars), vars
+        assert indexed_f(BooleanExpression.var_mask(
+            var_ids, vars)) == result.match(vars), vars
+    assert BooleanExpression.compile("\"it's\"").to_callable()({"it's"})
+    deep = BooleanVar("a")
+    for i in range(150):
+        deep = BooleanExpressionAnd(BooleanVar(str(i)), BooleanExpressionOr(BooleanVar("b"), deep))
+    deep_f = deep.to_callable()
+    for vars in [[], ["a"], ["b"], [str(i) for i in range(150)], [str(i) for i in range(150)] + ["a"]]:
+        assert deep_f(set(vars)) == deep.match(vars), vars
+
+    class Custom(BooleanExpression):
+        def _match(self, vars):
+            return "custom" in vars
+    try:
+        BooleanExpressionOr(BooleanVar("a"), Custom()).prepare()
+    except BooleanExpressionException:
+        pass
+    else:
+        raise AssertionError("custom node was indexed")
+    result = BooleanExpression.compile("[a & b] c")
+    assert result == BooleanExpressionOr(BooleanExpressionAnd(
+        BooleanVar("a"), BooleanVar("b")), BooleanVar("c")), result
+    assert result._eval_order == (BooleanVar("c"), BooleanExpressionAnd(
+        BooleanVar("a"), BooleanVar("b"))), result._eval_order
@@ -2,8 +2,24 @@
 
 import secrets
 
+def hex_to_bytes(hex: str) -> bytes:
+    return bytes.fromhex(hex)
+
+
+def bytes_to_hex(b: bytes) -> str:
+    return b.hex()
+
+
+def plain_to_bytes(plaintext: str) -> bytes:
+    return plaintext.encode("ascii")
+
+
+def bytes_to_plain(b: bytes) -> str:
+    return b.decode("ascii")
+
+
 def hex_to_ints(hex: str) -> list[int]:
-    return [b for b in bytes.fromhex(hex)]
+    return list(bytes.fromhex(hex))
 
 
 def ints_to_hex(ints: list[int]) -> str:
@@ -11,61 +27,76 @@ def ints_to_hex(ints: list[int]) -> str:
 
 
 def plain_to_ints(plaintext: str) -> list[int]:
-    return [ord(c) for c in plaintext]
+    return list(map(ord, plaintext))
 
 
 def ints_to_plain(ints: list[int]) -> str:
-    return "".join([chr(i) for i in ints])
+    return "".join(map(chr, ints))
 
 
 def plain_to_hex(plaintext: str) -> str:
-    return bytes(plaintext, encoding="ascii").hex()
+    return plain_to_bytes(plaintext).hex()
 
 
 def hex_to_plain(hex: str) -> str:
-    return ints_to_plain(hex_to_ints(hex))
+    return bytes.fromhex(hex).decode("latin-1")
 
 
 def xor(*int_lists: list[int]) -> list[int]:
     """ If the lists are of unequal size, shorter ones are cycled. """
-    max_len = max(len(l) for l in int_lists)
-    result = [0 for _ in range(0, max_len)]
-    for l in int_lists:
-        len_l = len(l)
-        result = [result[i] ^ l[i % len_l] for i in range(0, max_len)]
-    return result
+    try:
+        buffers = [bytes(l) for l in int_lists]
+    except ValueError:
+        # ints outside of 0-255 can't go through xor_bytes, XOR them one at a time instead
+        max_len = max(len(l) for l in int_lists)
+        result = [0] * max_len
+        for l in int_lists:
+            len_l = len(l)
+            result = [result[i] ^ l[i % len_l] for i in range(0, max_len)]
+        return result
+    return list(xor_bytes(*buffers))
+
+
+def xor_bytes(*buffers: bytes) -> bytes:
+    """ Same as `xor` for bytes-like objects. Each buffer is XORed in one operation as a single large int instead of byte by byte. """
+    max_len = max(len(b) for b in buffers)
+    result = 0
+    for b in buffers:
+        len_b = len(b)
+        if len_b < max_len:
+            b = (bytes(b) * (max_len // len_b + 1))[:max_len]
+        result ^= int.from_bytes(b)
+    return result.to_bytes(max_len)
 
 
 def random_bytes(length: int):
-    b = bytearray(length)
-    for i in range(0, length):
-        b[i] = secrets.randbits(8)
-    return b
+    return bytearray(secrets.token_bytes(length))
+
+
+# _GET_BIT[x][index], _SET_BIT[bit][x][index]
+_GET_BIT = [[(x >> (7-index)) & 1 for index in range(8)] for x in range(256)]
+_SET_BIT = [
+    [[x & (255 - (1 << (7-index))) for index in range(8)] for x in range(256)],
+    [[x | (1 << (7-index)) for index in range(8)] for x in range(256)],
+]
 
 
 def get_bit(x: int, index: int):
+    # asserts are removed with -O, which leaves only the table lookup
     assert 0 <= x < 256
     assert 0 <= index < 8
-    x >>= (7-index)
-    return x % 2
+    return _GET_BIT[x][index]
 
 
 def set_bit(x: int, index: int, bit: int) -> int:
     assert 0 <= x < 256
     assert 0 <= index < 8
     assert 0 <= bit <= 1
+    return _SET_BIT[bit][x][index]
+
 
-    if bit == 0:
-        return x & (255 - (1 << (7-index)))
-    else:
-        return x | (1 << (7-index))
+_BIT_STRINGS = [format(b, "08b") for b in range(256)]
 
 
 def bit_string(x: bytes) -> str:
-    byte_strings = []
-    for i in range(0, len(x)):
-        s = ""
-        for j in range(0, 8):
-            s += str(get_bit(x[i], j))
-        byte_strings.append(s)
-    return " ".join(byte_strings)
+    return " ".join([_BIT_STRINGS[b] for b in x])
@@ -1,19 +1,87 @@
 # (c) Andrew Chen (https://github.com/achen1296)
 
+import ctypes
 import platform
-import subprocess
+import time
+from ctypes import wintypes
 
 if platform.system() != "Windows":
     raise NotImplementedError
 
+# direct Win32 clipboard access, much faster than starting clip/powershell processes
+
+_user32 = ctypes.WinDLL("user32", use_last_error=True)
+_kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+
+_CF_UNICODETEXT = 13
+_GMEM_MOVEABLE = 0x0002
+
+_user32.OpenClipboard.argtypes = [wintypes.HWND]
+_user32.OpenClipboard.restype = wintypes.BOOL
+_user32.CloseClipboard.argtypes = []
+_user32.CloseClipboard.restype = wintypes.BOOL
+_user32.EmptyClipboard.argtypes = []
+_user32.EmptyClipboard.restype = wintypes.BOOL
+_user32.GetClipboardData.argtypes = [wintypes.UINT]
+_user32.GetClipboardData.restype = wintypes.HANDLE
+_user32.SetClipboardData.argtypes = [wintypes.UINT, wintypes.HANDLE]
+_user32.SetClipboardData.restype = wintypes.HANDLE
+_kernel32.GlobalAlloc.argtypes = [wintypes.UINT, ctypes.c_size_t]
+_kernel32.GlobalAlloc.restype = wintypes.HGLOBAL
+_kernel32.GlobalFree.argtypes = [wintypes.HGLOBAL]
+_kernel32.GlobalFree.restype = wintypes.HGLOBAL
+_kernel32.GlobalLock.argtypes = [wintypes.HGLOBAL]
+_kernel32.GlobalLock.restype = ctypes.c_void_p
+_kernel32.GlobalUnlock.argtypes = [wintypes.HGLOBAL]
+_kernel32.GlobalUnlock.restype = wintypes.BOOL
+
+
+def _open_clipboard(attempts: int = 10):
+    # another program may have the clipboard open for a moment
+    for _ in range(attempts):
+        if _user32.OpenClipboard(None):
+            return
+        time.sleep(0.01)
+    raise ctypes.WinError(ctypes.get_last_error())
+
 
 def copy(s: str):
-    subprocess.run("clip",
-                   creationflags=subprocess.CREATE_NO_WINDOW, shell=True, input=s, text=True)
+    data = s.encode("utf-16-le") + b"\0\0"
+    _open_clipboard()
+    try:
+        handle = _kernel32.GlobalAlloc(_GMEM_MOVEABLE, len(data))
+        if not handle:
+            raise ctypes.WinError(ctypes.get_last_error())
+        try:
+            locked = _kernel32.GlobalLock(handle)
+            if not locked:
+                raise ctypes.WinError(ctypes.get_last_error())
+            ctypes.memmove(locked, data, len(data))
+            _kernel32.GlobalUnlock(handle)
+            _user32.EmptyClipboard()
+            if not _user32.SetClipboardData(_CF_UNICODETEXT, handle):
+                raise ctypes.WinError(ctypes.get_last_error())
+        except:
+            # the system only takes ownership of the memory on success
+            _kernel32.GlobalFree(handle)
+            raise
+    finally:
+        _user32.CloseClipboard()
 
 
 def paste() -> str:
-    # extra \n added at the end by shell call
-    return subprocess.run("powershell -command \"get-clipboard\"",
-                          creationflags=subprocess.CREATE_NO_WINDOW,
-                          capture_output=True, text=True).stdout.removesuffix("\n")
+    _open_clipboard()
+    try:
+        handle = _user32.GetClipboardData(_CF_UNICODETEXT)
+        if not handle:
+            # no text on the clipboard
+            return ""
+        locked = _kernel32.GlobalLock(handle)
+        if not locked:
+            raise ctypes.WinError(ctypes.get_last_error())
+        try:
+            return ctypes.wstring_at(locked)
+        finally:
+            _kernel32.GlobalUnlock(handle)
+    finally:
+        _user32.CloseClipboard()
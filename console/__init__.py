@@ -1,15 +1,27 @@
 # (c) Andrew Chen (https://github.com/achen1296)
 
+import asyncio
 import cmd
+import contextlib
+import functools
 import inspect
+import itertools
 import os
 import re
+import sys
+import textwrap
 import time
 import traceback
 from pathlib import Path
 from shutil import get_terminal_size
 from typing import Any, Callable
 
+try:
+    import readline
+except ImportError:
+    # e.g. on Windows
+    readline = None
+
 import files
 import strings
 
@@ -19,50 +31,145 @@ from .stdio import *
 
 IN_VS_CODE = (os.environ.get("TERM_PROGRAM") == "vscode")
 
+_WHITESPACE = re.compile("\\s+")
+# quotes, brackets, and escapes for strings.argument_split
+_ARGUMENT_SPLIT_SPECIAL = frozenset("\"'()[]{}\\")
+# $x-y or $x in script commands
+_SCRIPT_ARG = re.compile("(\\$(\\d+)?-(\\d+)?)|\\$(\\d+)")
+
+
+# format(s, fg_color=Color.RED) without going through format()
+_EXC_START = f"{ESC}[{Color.RED.value}m"
+
 
 def print_as_exc(s: str, **print_kwargs):
-    print(format(s, fg_color=Color.RED), **print_kwargs)
-    bell()
+    text = _EXC_START + s + FORMAT_RESET + print_kwargs.pop("end", "\n")
+    if "file" in print_kwargs:
+        # the bell still goes to the console
+        print(text, end="", **print_kwargs)
+        bell()
+    else:
+        # a single write including the bell
+        print(text + BELL, end="", **print_kwargs)
+
+
+def _fast_input(prompt: str = ">> ") -> str:
+    """ Like input(), but for redirected stdin: the prompt is only written if stdout is a terminal, and nothing is flushed otherwise. """
+    if prompt and sys.stdout.isatty():
+        sys.stdout.write(prompt)
+        sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line:
+        raise EOFError
+    return line.removesuffix("\n")
 
 
 def input_generator(prompt: str = ">> "):
+    # keep input() for interactive use, which supports readline
+    read = input if sys.stdin.isatty() else _fast_input
     while True:
         try:
-            yield input(prompt)
+            yield read(prompt)
         except KeyboardInterrupt:
             print_as_exc("KeyboardInterrupt")
 
 
-def sleep(time_str: str):
-    """Pause execution for a certain amount of time, specified in h:mm:ss, m:ss, or s format. """
-    match: re.Match[str] | None = re.match(
-        "^(\\d+):(\\d{2}):(\\d{2})$", time_str)
-    if match:
-        hours = int(match.group(1))
-        minutes = int(match.group(2))
-        seconds = int(match.group(3))
+def _parse_time(time_str: str) -> int:
+    """ Seconds in a h:mm:ss, m:ss, or s time string. """
+    parts = time_str.split(":")
+    if not all(p.isdecimal() for p in parts):
+        raise ValueError("Invalid time string")
+    if len(parts) == 3 and len(parts[1]) == 2 and len(parts[2]) == 2:
+        hours, minutes, seconds = map(int, parts)
+    elif len(parts) == 2 and len(parts[0]) == 1 and len(parts[1]) == 2:
+        hours = 0
+        minutes, seconds = map(int, parts)
+    elif len(parts) == 1:
+        hours = minutes = 0
+        seconds = int(parts[0])
     else:
-        match = re.match("^(\\d):(\\d{2})$", time_str)
-        if match:
-            hours = 0
-            minutes = int(match.group(1))
-            seconds = int(match.group(2))
-        else:
-            match = re.match("^(\\d+)$", time_str)
-            if match:
-                hours = minutes = 0
-                seconds = int(match.group(1))
-            else:
-                raise Exception("Invalid time string")
+        raise ValueError("Invalid time string")
     if not (0 <= seconds <= 59 and 0 <= minutes <= 59):
-        raise Exception("Invalid time string")
-    sleep_time = seconds + 60*(minutes + 60*hours)
+        raise ValueError("Invalid time string")
+    return seconds + 60*(minutes + 60*hours)
+
+
+def sleep(time_str: str):
+    """Pause execution for a certain amount of time, specified in h:mm:ss, m:ss, or s format. """
+    sleep_time = _parse_time(time_str)
     print(f"Sleeping for {sleep_time} seconds")
     time.sleep(sleep_time)
 
 
+def _expand_script_arg(arg: str, script_args: tuple[str, ...]) -> list[str]:
+    """ Replace $x-y and $x in one script command argument, see `Cmd.execute_script`. """
+    matches = list(_SCRIPT_ARG.finditer(arg))
+    if not matches:
+        return [arg]
+    # alternating literal text and the script arguments captured by each $
+    parts: list[list[str] | tuple[str, ...]] = []
+    last_end = 0
+    for group in matches:
+        parts.append([arg[last_end:group.start()]])
+        if group.group(1):
+            # range
+            start = int(group.group(2)) if group.group(2) else 0
+            end = int(group.group(3)) if group.group(3) else len(script_args)
+        else:
+            start = int(group.group(4))
+            end = start+1
+        parts.append(script_args[start:end])
+        last_end = group.end()
+    parts.append([arg[last_end:]])
+    if len(matches) == 1:
+        prefix, captured, suffix = parts[0][0], parts[1], parts[2][0]
+        return [prefix + sa + suffix for sa in captured]
+    # every combination of the captured arguments, in order
+    return ["".join(p) for p in itertools.product(*parts)]
+
+
+# the script caches are bounded, since a long-running console can be asked about any number of names
+# the modification time arguments are only used to invalidate the caches when a file/directory changes, and cache_clear empties them completely
+
+
+@functools.lru_cache(maxsize=128)
+def _script_doc(script_path: str, mtime_ns: int, comment: re.Pattern) -> tuple[str, ...]:
+    """ The comment lines at the start of a script, ignoring empty lines. """
+    doc_lines = []
+    with open(script_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            match: re.Match[str] | None
+            if match := comment.match(line):
+                doc_lines.append(line[match.end():])
+            else:
+                # found a non-comment first
+                break
+    return tuple(doc_lines)
+
+
+@functools.lru_cache(maxsize=128)
+def _script_file(scripts_dir: Path, script_name: str, script_suffix: str) -> Path:
+    """ Where the script with the given name would be, whether or not it exists. """
+    return scripts_dir.joinpath(script_name).with_suffix(script_suffix)
+
+
+@functools.lru_cache(maxsize=16)
+def _script_names(scripts_dir: str, mtime_ns: int, script_suffix: str) -> tuple[str, ...]:
+    return tuple(f.stem for f in Path(scripts_dir).iterdir() if f.suffix == script_suffix)
+
+
 CmdLineType = str | list[str] | tuple[str, ...]
 
+# aliases every Cmd has, see the Cmd docstring
+_DEFAULT_ALIASES = {
+    "?": "help",
+    "quit": "exit",
+    "wait": "sleep",
+}
+
 
 class Cmd(cmd.Cmd):
     """ Adds some more features onto cmd.Cmd:
@@ -99,20 +206,39 @@ class Cmd(cmd.Cmd):
         if aliases is None:
             aliases = {}
         self.aliases = aliases
-        self.aliases.update({
-            "?": "help",
-            "quit": "exit",
-            "wait": "sleep",
-        })
+        self.aliases.update(_DEFAULT_ALIASES)
+        self._resolve_aliases()
         if scripts_dir is None:
             self.scripts_dir = None
         else:
             self.scripts_dir = Path(scripts_dir)
         self.script_suffix = script_suffix
 
+        # for _command_help
+        self._help_cache: dict[Callable, tuple[str, str | None]] = {}
+
+        # compiled command_sep and comment, see _command_sep_re and _comment_re
+        self._command_sep_compiled: re.Pattern | None = None
+        self._comment_compiled: re.Pattern | None = None
+
         # when errors occur, cmdqueue is moved into this variable for the continue command
         self.dropped_cmdqueue = []
 
+    def _resolve_aliases(self):
+        """ Point each alias directly at its final command, so that commands usually only need one lookup. """
+        for alias in self.aliases:
+            self.aliases[alias] = self._follow_alias(alias)
+
+    def _follow_alias(self, cmd: str) -> str:
+        """ Follow a chain of aliases to the command at the end of it. """
+        seen = {cmd}
+        while cmd in self.aliases:
+            cmd = self.aliases[cmd]
+            if cmd in seen:
+                raise ValueError(f"Alias cycle involving {cmd}")
+            seen.add(cmd)
+        return cmd
+
     def do_exit(self):
         """ Exit the console. """
         # stop flag
@@ -123,80 +249,129 @@ class Cmd(cmd.Cmd):
 
     do_sleep.__doc__ = sleep.__doc__
 
-    def cmdloop(self, intro=None):
-        """ Modifies the superclass cmdloop to catch KeyboardInterrupt without stopping, but conversely will stop on EOF (like the Python interactive shell), just after calling do_exit. """
+    def _set_completer(self):
+        if readline is not None and self.use_rawinput and self.completekey:
+            self.old_completer = readline.get_completer()
+            readline.set_completer(self.complete)
+            readline.parse_and_bind(self.completekey+": complete")
+
+    def _restore_completer(self):
+        if readline is not None and self.use_rawinput and self.completekey:
+            readline.set_completer(self.old_completer)
+
+    def _write_intro(self, intro):
+        if intro is not None:
+            self.intro = intro
+        if self.intro:
+            self.stdout.write(str(self.intro)+"\n")
+
+    def _pop_cmdqueue(self) -> CmdLineType:
+        """ Take the next queued command and echo it as though it were typed. """
+        line = self.cmdqueue.pop(0)
+        if isinstance(line, list):
+            joined_line = ' '.join(
+                (s if not _WHITESPACE.search(s) else f'"{s}"' for s in line))
+            print(f">> {joined_line}")
+        else:
+            print(f">> {line}")
+        return line
+
+    def _run_line(self, line: CmdLineType):
+        """ Run a line that has already been through precmd. """
+        stop = self.onecmd(line)
+        stop = self.postcmd(stop, line)
+        if not self.cmdqueue:
+            stop = self.postqueue(stop, line)
+        return stop
 
-        self.preloop()
-        if self.use_rawinput and self.completekey:
+    def _drop_cmdqueue(self, line: CmdLineType, x: BaseException):
+        # same output as traceback_wrap, but handled directly since this runs for every command
+        if isinstance(x, KeyboardInterrupt):
+            print_as_exc("KeyboardInterrupt")
+        else:
+            # traceback.format_exc includes a \n
+            print_as_exc(traceback.format_exc(), end="")
+        # put the failed command back on the front
+        self.dropped_cmdqueue = [line]+self.cmdqueue
+        self.cmdqueue = []
+
+    def _input_line(self) -> str:
+        """ Read one line in response to the prompt. Raises EOFError at the end of input. """
+        if self.use_rawinput:
+            return input(self.prompt)
+        self.stdout.write(self.prompt)
+        self.stdout.flush()
+        line = self.stdin.readline()
+        if not len(line):
+            raise EOFError
+        return line.rstrip('\r\n')
+
+    def _loop(self):
+        """ The body of `cmdloop` and `acmdloop`, which only differ in how they wait for input. Yields whenever a line of input is needed, which must be sent in, or the exception from reading it thrown in. Finishes when a command stops the loop or at EOF. """
+        line = ""
+        stop = False
+        while not stop:
             try:
-                import readline
-                self.old_completer = readline.get_completer()
-                readline.set_completer(self.complete)
-                readline.parse_and_bind(self.completekey+": complete")
-            except ImportError:
-                pass
-        try:
-            if intro is not None:
-                self.intro = intro
-            if self.intro:
-                self.stdout.write(str(self.intro)+"\n")
-
-            line = ""
-
-            def loop_body():
-                nonlocal line
                 if self.cmdqueue:
-                    line = self.cmdqueue.pop(0)
-                    if isinstance(line, list):
-                        whitespace = '\\s+'
-                        joined_line = ' '.join(
-                            (s if not re.search(whitespace, s) else f'"{s}"' for s in line))
-                        print(f">> {joined_line}")
-                    else:
-                        print(f">> {line}")
+                    line = self._pop_cmdqueue()
                 else:
-                    if self.use_rawinput:
-                        try:
-                            line = input(self.prompt)
-                        except EOFError:
-                            # stop on EOF
-                            self.do_exit()
-                            return True
-                    else:
-                        self.stdout.write(self.prompt)
-                        self.stdout.flush()
-                        line = self.stdin.readline()
-                        if not len(line):
-                            # stop on EOF
-                            self.do_exit()
-                            return True
-                        else:
-                            line = line.rstrip('\r\n')
+                    try:
+                        line = yield
+                    except EOFError:
+                        # stop on EOF
+                        self.do_exit()
+                        return
+                # assigned before running so that the command saved for continue is the one that failed, not the whole line that was split
                 line = self.precmd(line)
-                stop = self.onecmd(line)
-                stop = self.postcmd(stop, line)
-                if not self.cmdqueue:
-                    stop = self.postqueue(stop, line)
-                return stop
-
-            stop = False
-            while not stop:
-                try:
-                    stop = traceback_wrap(
-                        loop_body, pause_message=None, reraise=True)
-                except:
-                    # put the failed command back on the front
-                    self.dropped_cmdqueue = [line]+self.cmdqueue
-                    self.cmdqueue = []
+                stop = self._run_line(line)
+            except (Exception, KeyboardInterrupt) as x:
+                self._drop_cmdqueue(line, x)
 
+    @contextlib.contextmanager
+    def _looping(self, intro):
+        """ Everything around the loop itself in `cmdloop` and `acmdloop`. postloop is skipped if the loop ends with an exception, but the completer is always restored. """
+        self.preloop()
+        self._set_completer()
+        try:
+            self._write_intro(intro)
+            yield
             self.postloop()
         finally:
-            if self.use_rawinput and self.completekey:
-                try:
-                    import readline
-                    readline.set_completer(self.old_completer)
-                except ImportError:
-                    pass
+            self._restore_completer()
+
+    def cmdloop(self, intro=None):
+        """ Modifies the superclass cmdloop to catch KeyboardInterrupt without stopping, but conversely will stop on EOF (like the Python interactive shell), just after calling do_exit. """
+        with self._looping(intro):
+            loop = self._loop()
+            try:
+                next(loop)
+                while True:
+                    try:
+                        line = self._input_line()
+                    except (Exception, KeyboardInterrupt) as x:
+                        loop.throw(x)
+                    else:
+                        loop.send(line)
+            except StopIteration:
+                pass
+
+    async def acmdloop(self, intro=None):
+        """ Like `cmdloop`, but waits for input in another thread, so that other tasks on the event loop keep running in the meantime. Commands themselves still run on the event loop thread. KeyboardInterrupt and EOF are handled the same way as in `cmdloop`.
+
+        Cancelling the task while it waits for input stops the loop (without calling postloop) and the CancelledError is raised as usual. The thread waiting for input cannot be interrupted, so it is left to finish on its own. Note that asyncio.run handles Ctrl-C by cancelling the main task rather than raising KeyboardInterrupt in it. """
+        with self._looping(intro):
+            loop = self._loop()
+            try:
+                next(loop)
+                while True:
+                    try:
+                        line = await asyncio.to_thread(self._input_line)
+                    except (Exception, KeyboardInterrupt) as x:
+                        loop.throw(x)
+                    else:
+                        loop.send(line)
+            except StopIteration:
+                pass
 
     def precmd(self, line: CmdLineType):  # type: ignore (intentional incompatible override)
         """ Split commands by self.command_sep. """
@@ -204,14 +379,45 @@ class Cmd(cmd.Cmd):
             # pass through pre-parsed command
             return line
         # keep empty splits since this can be used intentionally to repeat a command
-        cmds = strings.argument_split(
-            line, self.command_sep, split_compounds=False, remove_empty_args=False)
+        cmds = self._split_commands(line, remove_empty=False)
         if len(cmds) <= 1:
             return line
         # add new commands onto the FRONT of the queue so that things will execute in the expected order in case nested
         self.cmdqueue = cmds[1:] + self.cmdqueue
         return cmds[0]
 
+    @staticmethod
+    def _recompile(compiled: re.Pattern | None, pattern: str | re.Pattern) -> re.Pattern:
+        """ compiled, unless it is not for pattern (any more), in which case pattern is compiled. """
+        if compiled is None or (compiled is not pattern and compiled.pattern != pattern):
+            compiled = re.compile(pattern)
+        return compiled
+
+    @property
+    def _command_sep_re(self) -> re.Pattern:
+        """ command_sep compiled, again if it has been changed since. """
+        compiled = self._command_sep_compiled = self._recompile(
+            self._command_sep_compiled, self.command_sep)
+        return compiled
+
+    @property
+    def _comment_re(self) -> re.Pattern:
+        """ comment compiled, again if it has been changed since. """
+        compiled = self._comment_compiled = self._recompile(
+            self._comment_compiled, self.comment)
+        return compiled
+
+    def _split_commands(self, line: str, remove_empty: bool = True) -> list[str]:
+        """ Split by self.command_sep, but not inside quotes/brackets. """
+        command_sep_re = self._command_sep_re
+        if command_sep_re.groups == 0 and _ARGUMENT_SPLIT_SPECIAL.isdisjoint(line):
+            # nothing that argument_split would treat specially, so a plain split gives the same result
+            cmds = command_sep_re.split(line)
+            if remove_empty:
+                cmds = [c for c in cmds if c != ""]
+            return cmds
+        return strings.argument_split(line, command_sep_re, split_compounds=False, remove_empty_args=remove_empty)
+
     def onecmd(self, line: CmdLineType) -> bool | None:  # type: ignore
         # (intentional incompatible override)
         """ Interpret the argument as though it had been typed in response
@@ -223,27 +429,34 @@ class Cmd(cmd.Cmd):
             line = line.strip()
             if not line:
                 return self.emptyline()
-            cmd, *args = strings.argument_split(line)
-        elif isinstance(line, list) or isinstance(line, tuple):
+            if _ARGUMENT_SPLIT_SPECIAL.isdisjoint(line):
+                # nothing that argument_split would treat specially, str.split splits on the same whitespace
+                cmd, *args = line.split()
+            else:
+                cmd, *args = strings.argument_split(line)
+        elif isinstance(line, (list, tuple)):
             cmd, *args = line
         else:
             raise TypeError(
                 "Input must be a string or a pre-parsed list of strings")
-        while cmd in self.aliases:
-            cmd = self.aliases[cmd]
-        try:
-            func: Callable[..., bool | None] = getattr(self, 'do_' + cmd)
-        except AttributeError:
-            if self.scripts_dir is not None and (script_path := self._script_path(cmd)).exists():
-                func = self.execute_script
-                # pass the script path to execute_script
-                args = [str(script_path)] + args
-            else:
-                func = self.default
-                # pass the first split argument to default
-                args = [cmd] + args
         self.lastcmd: CmdLineType = line  # type: ignore
         # (intentional incompatible override)
+        # aliases were resolved to their final command ahead of time, see _resolve_aliases
+        cmd = self.aliases.get(cmd, cmd)
+        # looked up every time, since do_ methods may be added or replaced on the instance at any time
+        func: Callable[..., bool | None] | None = getattr(
+            self, 'do_' + cmd, None)
+        if func is None and cmd in self.aliases:
+            # an alias added after __init__ may point at another alias
+            cmd = self._follow_alias(cmd)
+            func = getattr(self, 'do_' + cmd, None)
+        if func is None:
+            # the extra first argument is passed directly rather than building a new argument list
+            if self.scripts_dir is not None and (script_path := self._script_path(cmd)).exists():
+                # pass the script path to execute_script
+                return self.execute_script(str(script_path), *args)
+            # pass the first split argument to default
+            return self.default(cmd, *args)
 
         # try:
         return func(*args)
@@ -264,7 +477,7 @@ class Cmd(cmd.Cmd):
         self.cmdqueue = self.dropped_cmdqueue
 
     def _script_path(self, script_name):
-        return self.scripts_dir.joinpath(script_name).with_suffix(self.script_suffix)
+        return _script_file(self.scripts_dir, script_name, self.script_suffix)
 
     LEVENSHTEIN_MAX = 3
 
@@ -298,64 +511,30 @@ class Cmd(cmd.Cmd):
                     else:
                         try:
                             cmd_func = getattr(self, 'do_' + cmd)
-                            print(inspect.signature(cmd_func),
-                                  file=self.stdout)
-                            doc: str = cmd_func.__doc__
+                        except AttributeError:
+                            pass
+                        else:
+                            signature, doc = self._command_help(cmd_func)
+                            print(signature, file=self.stdout)
                             if doc:
                                 print()
-
-                                # strip leading whitespace based on the second non-whitespace line
-                                lines = doc.split("\n")
-                                found_first_non_white = False
-                                l2 = None
-                                for l in lines:
-                                    if l.strip():
-                                        # not all whitespace
-                                        if not found_first_non_white:
-                                            found_first_non_white = True
-                                        else:
-                                            # found the second non-whitespace line
-                                            l2 = l
-                                            break
-                                if l2:
-                                    # this pattern is guaranteed to match
-                                    match: re.Match[str] = re.match(
-                                        "\\s*", l2)  # type: ignore
-                                    whitespace_prefix = match.string[:match.end(
-                                    )]
-                                    lines = [l.removeprefix(
-                                        whitespace_prefix)for l in lines]
-                                    doc = "\n".join(lines)
-
                                 print(doc, file=self.stdout)
                                 continue
-                        except AttributeError:
-                            pass
 
-                        script_path = self._script_path(cmd)
-                        if script_path.exists():
-                            found_script_doc_comment = False
-                            with open(script_path) as f:
-                                for line in f:
-                                    line = line.strip()
-                                    if not line:
-                                        continue
-                                    match: re.Match[str] | None
-                                    if match := re.match(self.comment, line):
-                                        print(line[match.end():],
-                                              file=self.stdout)
-                                        found_script_doc_comment = True
-                                    else:
-                                        # found a non-comment first
-                                        break
-                            if found_script_doc_comment:
+                        if self.scripts_dir is not None and (script_path := self._script_path(cmd)).exists():
+                            doc_lines = _script_doc(
+                                str(script_path), script_path.stat().st_mtime_ns, self._comment_re)
+                            if doc_lines:
+                                for doc_line in doc_lines:
+                                    print(doc_line, file=self.stdout)
                                 continue
 
                         print(str(self.nohelp % (cmd,)), file=self.stdout)
                         continue
                 help_func()
         else:
-            names = sorted(set(dir(self)))
+            # only used to build sets, so dir's own sorting is enough
+            names = dir(self)
             cmds: set[str] = {name[3:] for name in names if name[:3] == 'do_'}
             help = {name[5:] for name in names if name[:5] == 'help_'}
 
@@ -363,8 +542,8 @@ class Cmd(cmd.Cmd):
                 self, "do_" + cmd).__doc__} | (help & cmds)
             misc_topics = help - cmds
             cmds_undoc = cmds - cmds_doc
-            scripts = [f.stem for f in self.scripts_dir.iterdir()
-                       if f.suffix == self.script_suffix] if self.scripts_dir else []
+            scripts = _script_names(str(self.scripts_dir), self.scripts_dir.stat(
+            ).st_mtime_ns, self.script_suffix) if self.scripts_dir else []
             print(self.doc_leader, file=self.stdout)
             terminal_width = get_terminal_size().columns
             # the cmdlen argument is strangely not used in the superclass, so I have replaced it with None
@@ -379,6 +558,22 @@ class Cmd(cmd.Cmd):
             self.print_topics(self.scripts_header,
                               list(scripts), None, terminal_width)
 
+    def _command_help(self, cmd_func: Callable) -> tuple[str, str | None]:
+        """ The signature and docstring (dedented) of a do_ method. Cached, since inspect.signature is slow. """
+        # bound methods are created again on every access, so use the underlying function
+        key = getattr(cmd_func, "__func__", cmd_func)
+        cached = self._help_cache.get(key)
+        if cached is None:
+            doc: str | None = cmd_func.__doc__
+            if doc:
+                # the first line is usually not indented like the rest
+                first, _, rest = doc.partition("\n")
+                if rest:
+                    doc = first + "\n" + textwrap.dedent(rest)
+            cached = self._help_cache[key] = (
+                str(inspect.signature(cmd_func)), doc)
+        return cached
+
     def execute_script(self, script: files.PathLike, *script_args):
         """ Used before the default method if the class was instantiated with a scripts_dir.
 
@@ -407,8 +602,7 @@ class Cmd(cmd.Cmd):
         """
 
         cmds = []
-
-        len_script_args = len(script_args)
+        comment_re = self._comment_re
 
         with open(script) as f:
             for line in f:
@@ -416,36 +610,13 @@ class Cmd(cmd.Cmd):
                 if not line:
                     # empty line
                     continue
-                if re.match(self.comment, line):
+                if comment_re.match(line):
                     # comment
                     continue
-                for cmd in strings.argument_split(line, self.command_sep, split_compounds=False):
-                    cmd_args = strings.argument_split(cmd)
-                    i = 0
-                    while i < len(cmd_args):
-                        ca = cmd_args[i]
-                        while group := re.search("(\\$(\\d+)?-(\\d+)?)|\\$(\\d+)", ca):
-                            if group.group(1):
-                                # range
-                                if group.group(2):
-                                    start = int(group.group(2))
-                                else:
-                                    start = 0
-                                if group.group(3):
-                                    end = int(group.group(3))
-                                else:
-                                    end = len_script_args
-                            else:
-                                # assert match.group(4)
-                                start = int(group.group(4))
-                                end = start+1
-                            cmd_args[i:i+1] = [ca[:group.start()] + sa + ca[group.end():] for sa in
-                                               script_args[start:end]]
-                            if i >= len(cmd_args):
-                                # last arg was deleted
-                                break
-                            ca = cmd_args[i]
-                        i += 1
+                for cmd in self._split_commands(line):
+                    cmd_args = []
+                    for ca in strings.argument_split(cmd):
+                        cmd_args.extend(_expand_script_arg(ca, script_args))
                     cmds.append(cmd_args)
 
         # add new commands onto the FRONT of the queue so that things will execute in the expected order in case nested
@@ -494,7 +665,199 @@ def split_print(*args, file=None, **kwargs):
     print(*args, file=file, **kwargs)
 
 
+def _test_scripted():
+    """ Non-interactive checks for `test`, feeding Cmd its input from a list of lines. """
+    import io
+    import threading
+
+    class ScriptedInput:
+        """ Raises exceptions in the lines instead of returning them, and blocks on an Event until it is set. """
+
+        def __init__(self, lines: list):
+            self.lines = lines
+            self.waiting = threading.Event()
+
+        def readline(self):
+            if not self.lines:
+                return ""
+            line = self.lines.pop(0)
+            if isinstance(line, BaseException):
+                raise line
+            if isinstance(line, threading.Event):
+                self.waiting.set()
+                line.wait()
+                return ""
+            return line + "\n"
+
+    class ScriptedCmd(Cmd):
+        def __init__(self, *lines):
+            super().__init__(stdin=ScriptedInput(list(lines)), stdout=io.StringIO())
+            self.use_rawinput = False
+            self.fail_next = True
+            self.echoed = []
+
+        def do_flaky(self):
+            if self.fail_next:
+                self.fail_next = False
+                raise Exception("flaky")
+
+        def do_echo(self, *args):
+            self.echoed.append(args)
+
+    for run in (ScriptedCmd.cmdloop, lambda c: asyncio.run(c.acmdloop())):
+        # continue retries the failed command and the rest of its line once
+        c = ScriptedCmd("flaky; echo one; echo two", "continue")
+        with contextlib.redirect_stdout(io.StringIO()):
+            run(c)
+        assert c.echoed == [("one",), ("two",)], c.echoed
+
+        # Ctrl-C at the prompt is printed and the loop goes on
+        c = ScriptedCmd(KeyboardInterrupt(), "echo after")
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            run(c)
+        assert c.echoed == [("after",)], c.echoed
+        assert "KeyboardInterrupt" in out.getvalue(), out.getvalue()
+
+    # do_ methods replaced on the instance after __init__ are the ones called
+    c = ScriptedCmd("echo x")
+    c.do_echo = lambda *args: c.echoed.append(("replaced",) + args)
+    with contextlib.redirect_stdout(io.StringIO()):
+        c.cmdloop()
+    assert c.echoed == [("replaced", "x")], c.echoed
+
+    # aliases added after __init__ are followed to the end of their chain
+    c = ScriptedCmd("ee 2", "q", "echo not reached")
+    c.aliases["e"] = "echo"
+    c.aliases["ee"] = "e"
+    c.aliases["q"] = "quit"
+    with contextlib.redirect_stdout(io.StringIO()):
+        c.cmdloop()
+    assert c.echoed == [("2",)], c.echoed
+
+    # cancelling acmdloop while it waits for input stops it
+    release = threading.Event()
+    c = ScriptedCmd("echo before", release, "echo not reached")
+
+    async def cancel_while_waiting():
+        task = asyncio.create_task(c.acmdloop())
+        try:
+            await asyncio.to_thread(c.stdin.waiting.wait)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            else:
+                raise AssertionError("acmdloop was not cancelled")
+        finally:
+            release.set()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        asyncio.run(cancel_while_waiting())
+    assert c.echoed == [("before",)], c.echoed
+
+
+def _test_progress():
+    """ Non-interactive checks for `test` that the partial redraws of ProgressBar leave the same screen as full redraws. """
+    import io
+
+    width = 40
+    csi = re.compile(f"{re.escape(ESC)}\\[(\\d*)([A-Za-z])|(.)", re.DOTALL)
+
+    def render(output: str) -> tuple[list[str], tuple[int, int]]:
+        """ The lines of a terminal that is width cells wide (and never scrolls) after output is written to it, and the cursor position. Only handles what Progress writes. """
+        screen: list[list[str]] = [[" "] * width]
+        row = column = 0
+        # after writing to the last column, the cursor stays there until the next character
+        pending_wrap = False
+        for m in csi.finditer(output):
+            count, command, char = m.groups()
+            if command is not None:
+                pending_wrap = False
+                n = int(count) if count else None
+                if command == "A":
+                    row = max(row - (n or 1), 0)
+                elif command == "C":
+                    column = min(column + (n or 1), width - 1)
+                elif command == "G":
+                    column = min((n or 1) - 1, width - 1)
+                elif command == "J" and not n:
+                    screen[row][column:] = [" "] * (width - column)
+                    del screen[row+1:]
+                else:
+                    raise AssertionError(f"unexpected escape {m.group()!r}")
+                continue
+            if char == "\r":
+                column = 0
+                pending_wrap = False
+                continue
+            if char == "\n" or pending_wrap:
+                row += 1
+                column = 0
+                pending_wrap = False
+                while len(screen) <= row:
+                    screen.append([" "] * width)
+                if char == "\n":
+                    continue
+            screen[row][column] = char
+            if column == width - 1:
+                pending_wrap = True
+            else:
+                column += 1
+        return ["".join(line).rstrip() for line in screen], (row, column)
+
+    class FullRedraw(ProgressBar):
+        """ Writes every frame in full, and measures it without the comment cache. """
+        _draw = Progress._draw
+
+        def _measure(self, prog_text: str, comment: str | None) -> int:
+            return measure_lines(prog_text + (comment or ""), self._terminal_width())
+
+    def check(*steps: Callable[[ProgressBar], Any]):
+        """ Run each step on a ProgressBar and on one that always redraws fully, comparing the screens after every step. """
+        bars = []
+        outputs = []
+        for cls in (ProgressBar, FullRedraw):
+            bar = cls(100, complete="#", min_update_time=0)
+            bar._terminal_width = lambda: width
+            bars.append(bar)
+            outputs.append(io.StringIO())
+        for i, step in enumerate(steps):
+            for bar, output in zip(bars, outputs):
+                with contextlib.redirect_stdout(output):
+                    step(bar)
+            partial, full = (render(output.getvalue()) for output in outputs)
+            assert partial == full, (i, partial, full)
+        return [len(output.getvalue()) for output in outputs]
+
+    def update(value, comment=None):
+        return lambda bar: bar.update_progress(value, comment)
+
+    # a bar that grows, only the new characters are written
+    partial_length, full_length = check(*(update(i) for i in range(0, 101, 3)))
+    assert partial_length < full_length, (partial_length, full_length)
+    # a bar that shrinks
+    check(update(80), update(81), update(40), update(41))
+    # a comment after a bar, kept by the following updates without one, then replaced and removed
+    check(update(10), update(20, "comment"), update(30), update(40),
+          update(50, "a\ncomment that is longer than the terminal is wide"), update(60), update(70, ""), update(80))
+    # the progress text gets wider and narrower, and the bar is given a width
+    check(update(10), update(20), update(1000), update(30), update(40),
+          lambda bar: setattr(bar, "width", 30), update(50), update(60))
+    # clearing and starting again
+    check(update(10), update(20), lambda bar: bar.clear(), update(5), update(15))
+
+
 def test():
+    _test_scripted()
+    _test_progress()
+
+    # command_sep can be changed after __init__
+    c = Cmd()
+    c.command_sep = "\\s*,\\s*"
+    assert c.precmd("echo a, echo b") == "echo a", c.cmdqueue
+    assert c.cmdqueue == ["echo b"], c.cmdqueue
+
     class CmdTest(Cmd):
         def __init__(self):
             super().__init__(scripts_dir=".")
@@ -510,17 +873,19 @@ def test():
         def do_p(self, _):
             # ints
             prog = ProgressBar(100)
+            # built beforehand so the loop only exercises the progress bar
+            comments = [f"{i:03}"*((100-i)//30+1) + "\n\ncomment"
+                        for i in range(0, 101)]
             for i in range(0,  101):
-                prog.update_progress(
-                    i, f"{i:03}"*((100-i)//30+1) + "\n\ncomment")
+                prog.update_progress(i, comments[i])
                 time.sleep(0.05)
             prog.clear()
 
             # floats, long comments
             prog = ProgressBar(100.)
+            long_comment = "long comment "*15
             for i in range(0, 101):
-                prog.update_progress(
-                    float(i), "long comment "*15)
+                prog.update_progress(float(i), long_comment)
                 time.sleep(0.05)
             prog.clear()
 
@@ -532,6 +897,21 @@ def test():
                 time.sleep(0.05)
             prog.clear()
 
+            # wrapping an iterable
+            prog = ProgressBar(100)
+            for _ in prog.wrap(range(0, 100)):
+                time.sleep(0.05)
+            prog.clear()
+
+            # drawn from a background thread
+            prog = ProgressBar(100)
+            prog.start_async()
+            for i in range(0, 100):
+                prog.inc()
+                time.sleep(0.05)
+            prog.stop()
+            prog.clear()
+
             # test rate limit
             for _ in range(0, 100):
                 spin()
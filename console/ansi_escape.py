@@ -3,7 +3,11 @@
 # en.wikipedia.org/wiki/ANSI_escape_code
 # learn.microsoft.com/en-us/windows/console/console-virtual-terminal-sequences
 # all of these functions print directly to the console because they are not supposed to be used anywhere else anyway
+# the *_str versions return the escape sequence instead, so that several can be combined into one write
 
+import functools
+import os
+import sys
 from enum import Enum
 from shutil import get_terminal_size
 
@@ -12,37 +16,95 @@ def measure_lines(text: str, terminal_width: int | None = None):
     """ Measure how many lines tall the text would be in a terminal of the given width. If not given a terminal width, gets the current one. """
     if terminal_width is None:
         terminal_width = get_terminal_size().columns
+    if "\n" not in text:
+        # the usual case of a single line does not need splitting
+        return 1 + (len(text) - 1) // terminal_width if text else 1
     lines = text.split("\n")
-    count = len(lines)
-    for l in lines:
-        len_l = len(l)
-        if len_l == 0:
-            # avoid negatives in the equation below
-            continue
-        # decrement length because exactly filling the terminal does not go onto the next line
-        count += (len_l - 1) // terminal_width
-    return count
+    # decrement length because exactly filling the terminal does not go onto the next line
+    # skip empty lines to avoid negatives
+    return len(lines) + sum((len(l) - 1) // terminal_width for l in lines if l)
 
 
 ESC = "\x1b"
 ST = ESC + "\\"
 
+# escape sequences without parameters
+BELL = "\u0007"
+CURSOR_REVERSE_INDEX = f"{ESC}M"
+CURSOR_SAVE = f"{ESC}7"
+CURSOR_RESTORE = f"{ESC}8"
+CURSOR_BLINK_ON = f"{ESC}[?12h"
+CURSOR_BLINK_OFF = f"{ESC}[?12l"
+CURSOR_SHOW = f"{ESC}[?25h"
+CURSOR_HIDE = f"{ESC}[?25l"
+SET_TAB_STOP = f"{ESC}H"
+CLEAR_TAB_STOP = f"{ESC}[0g"
+CLEAR_ALL_TAB_STOPS = f"{ESC}[3g"
+ALTERNATE_SCREEN_BUFFER = f"{ESC}[?1049h"
+MAIN_SCREEN_BUFFER = f"{ESC}[?1049l"
+SOFT_RESET = f"{ESC}[!p"
+
+
+# the Windows console only decodes text written through sys.stdout correctly, raw bytes that are not ASCII come out garbled
+_WINDOWS = sys.platform == "win32"
+
+# the stream that _stdout_fd and _stdout_encoding were taken from, so they are refreshed if sys.stdout is replaced (e.g. redirected)
+_stdout_stream = None
+_stdout_fd: int | None = None
+_stdout_encoding = "utf-8"
+_stdout_errors = "strict"
+
+
+def _write(s: str):
+    """ Write directly to the file descriptor behind sys.stdout, skipping the text layer, which is worth it for the many small writes of a redrawing display. Falls back to sys.stdout.write if there is no file descriptor (e.g. StringIO), and on Windows for text that is not ASCII. """
+    global _stdout_stream, _stdout_fd, _stdout_encoding, _stdout_errors
+    stream = sys.stdout
+    if stream is not _stdout_stream:
+        try:
+            _stdout_fd = stream.fileno()
+        except (AttributeError, OSError, ValueError):
+            _stdout_fd = None
+        _stdout_encoding = getattr(stream, "encoding", None) or "utf-8"
+        _stdout_errors = getattr(stream, "errors", None) or "strict"
+        _stdout_stream = stream
+    if _stdout_fd is None or (_WINDOWS and not s.isascii()):
+        stream.write(s)
+        return
+    data = s.encode(_stdout_encoding, _stdout_errors)
+    # anything already printed normally must come out first
+    stream.flush()
+    while data:
+        data = data[os.write(_stdout_fd, data):]
+
 
 def bell():
     """Print the "bell" character. """
-    print('\u0007', end="")
+    _write(BELL)
+
+
+def write_escapes(*codes: str):
+    """ Write several escape sequences (e.g. from the `*_str` functions) with a single write. """
+    _write("".join(codes))
 
 
 def cursor_reverse_index():
-    print(f"{ESC}M", end="")
+    _write(CURSOR_REVERSE_INDEX)
+
+
+def cursor_save_str():
+    return CURSOR_SAVE
 
 
 def cursor_save():
-    print(f"{ESC}7", end="")
+    _write(cursor_save_str())
+
+
+def cursor_restore_str():
+    return CURSOR_RESTORE
 
 
 def cursor_restore():
-    print(f"{ESC}8", end="")
+    _write(cursor_restore_str())
 
 
 class CursorMoveException(Exception):
@@ -55,71 +117,98 @@ def _check_cursor_move(i: int):
             "Cursor move argument must be between 0 and 32767 inclusive.")
 
 
-def cursor_up(i: int = 1):
+@functools.lru_cache(maxsize=256)
+def cursor_move_str(i: int, letter: str):
+    """ Relative cursor movement, letter is the final character of the escape sequence, e.g. A for up. """
     # 0 is treated as 1 if sent normally!
     if i == 0:
-        return
+        return ""
     _check_cursor_move(i)
-    print(f"{ESC}[{i}A", end="")
+    return f"{ESC}[{i}{letter}"
+
+
+def cursor_up_str(i: int = 1):
+    return cursor_move_str(i, "A")
+
+
+def cursor_up(i: int = 1):
+    _write(cursor_up_str(i))
+
+
+def cursor_down_str(i: int = 1):
+    return cursor_move_str(i, "B")
 
 
 def cursor_down(i: int = 1):
-    # 0 is treated as 1 if sent normally!
-    if i == 0:
-        return
-    _check_cursor_move(i)
-    print(f"{ESC}[{i}B", end="")
+    _write(cursor_down_str(i))
+
+
+def cursor_forward_str(i: int = 1):
+    return cursor_move_str(i, "C")
 
 
 def cursor_forward(i: int = 1):
-    # 0 is treated as 1 if sent normally!
-    if i == 0:
-        return
-    _check_cursor_move(i)
-    print(f"{ESC}[{i}C", end="")
+    _write(cursor_forward_str(i))
+
+
+def cursor_back_str(i: int = 1):
+    return cursor_move_str(i, "D")
 
 
 def cursor_back(i: int = 1):
-    # 0 is treated as 1 if sent normally!
-    if i == 0:
-        return
-    _check_cursor_move(i)
-    print(f"{ESC}[{i}D", end="")
+    _write(cursor_back_str(i))
+
+
+def cursor_next_line_str(i: int = 1):
+    return cursor_move_str(i, "E")
 
 
 def cursor_next_line(i: int = 1):
-    # 0 is treated as 1 if sent normally!
-    if i == 0:
-        return
-    _check_cursor_move(i)
-    print(f"{ESC}[{i}E", end="")
+    _write(cursor_next_line_str(i))
+
+
+def cursor_previous_line_str(i: int = 1):
+    return cursor_move_str(i, "F")
 
 
 def cursor_previous_line(i: int = 1):
-    # 0 is treated as 1 if sent normally!
-    if i == 0:
-        return
+    _write(cursor_previous_line_str(i))
+
+
+@functools.lru_cache(maxsize=256)
+def cursor_horizontal_absolute_str(i: int = 1):
+    """ Note that 0 is treated as 1 """
     _check_cursor_move(i)
-    print(f"{ESC}[{i}F", end="")
+    return f"{ESC}[{i}G"
 
 
 def cursor_horizontal_absolute(i: int = 1):
+    """ Note that 0 is treated as 1 """
+    _write(cursor_horizontal_absolute_str(i))
+
+
+@functools.lru_cache(maxsize=256)
+def cursor_vertical_absolute_str(i: int = 1):
     """ Note that 0 is treated as 1 """
     _check_cursor_move(i)
-    print(f"{ESC}[{i}G", end="")
+    return f"{ESC}[{i}d"
 
 
 def cursor_vertical_absolute(i: int = 1):
     """ Note that 0 is treated as 1 """
-    _check_cursor_move(i)
-    print(f"{ESC}[{i}d", end="")
+    _write(cursor_vertical_absolute_str(i))
 
 
-def cursor_set_position(x: int = 1, y: int = 1):
+def cursor_set_position_str(x: int = 1, y: int = 1):
     """ Note that 0 is treated as 1 for both coordinates """
     _check_cursor_move(x)
     _check_cursor_move(y)
-    print(f"{ESC}[{y};{x}H", end="")
+    return f"{ESC}[{y};{x}H"
+
+
+def cursor_set_position(x: int = 1, y: int = 1):
+    """ Note that 0 is treated as 1 for both coordinates """
+    _write(cursor_set_position_str(x, y))
 
 
 """def get_cursor_position() -> tuple[int, int]:
@@ -134,16 +223,16 @@ def cursor_set_position(x: int = 1, y: int = 1):
 
 def cursor_blink(blink: bool = True):
     if blink:
-        print(f"{ESC}[?12h", end="")
+        _write(CURSOR_BLINK_ON)
     else:
-        print(f"{ESC}[?12l", end="")
+        _write(CURSOR_BLINK_OFF)
 
 
 def cursor_show(show: bool = True):
     if show:
-        print(f"{ESC}[?25h", end="")
+        _write(CURSOR_SHOW)
     else:
-        print(f"{ESC}[?25l", end="")
+        _write(CURSOR_HIDE)
 
 
 class CursorShape(Enum):
@@ -156,24 +245,30 @@ class CursorShape(Enum):
     STEADY_BAR = 6
 
 
+@functools.lru_cache(maxsize=256)
+def _count_str(i: int, letter: str):
+    """ Escape sequence taking a single count, e.g. S for scrolling down, cached since nearly every call uses the same few (mostly default) counts. Unlike cursor_move_str, 0 is sent as is. """
+    return f"{ESC}[{i}{letter}"
+
+
 def cursor_shape(shape: CursorShape):
-    print(f"{ESC}[{shape.value} q", end="")
+    _write(f"{ESC}[{shape.value} q")
 
 
 def scroll_down(i: int = 1):
-    print(f"{ESC}[{i}S", end="")
+    _write(_count_str(i, "S"))
 
 
 def scroll_up(i: int = 1):
-    print(f"{ESC}[{i}T", end="")
+    _write(_count_str(i, "T"))
 
 
 def insert_characters(i: int = 1):
-    print(f"{ESC}[{i}@", end="")
+    _write(_count_str(i, "@"))
 
 
 def delete_characters(i: int = 1):
-    print(f"{ESC}[{i}P", end="")
+    _write(_count_str(i, "P"))
 
 
 def backspace(i: int = 1):
@@ -182,55 +277,55 @@ def backspace(i: int = 1):
 
 
 def erase_characters(i: int = 1):
-    print(f"{ESC}[{i}X", end="")
+    _write(_count_str(i, "X"))
 
 
 def insert_lines(i: int = 1):
-    print(f"{ESC}[{i}L", end="")
+    _write(_count_str(i, "L"))
 
 
 def delete_lines(i: int = 1):
-    print(f"{ESC}[{i}M", end="")
+    _write(_count_str(i, "M"))
 
 
 def set_tab_stop():
-    print(f"{ESC}H", end="")
+    _write(SET_TAB_STOP)
 
 
 def tab_forward(i: int = 1):
-    print(f"{ESC}[{i}I", end="")
+    _write(_count_str(i, "I"))
 
 
 def tab_backward(i: int = 1):
-    print(f"{ESC}[{i}Z", end="")
+    _write(_count_str(i, "Z"))
 
 
 def clear_tab_stop():
-    print(f"{ESC}[0g", end="")
+    _write(CLEAR_TAB_STOP)
 
 
 def clear_all_tab_stops():
-    print(f"{ESC}[3g", end="")
+    _write(CLEAR_ALL_TAB_STOPS)
 
 
 def set_scroll_region(top: int | None = None, bottom: int | None = None):
-    print(f"{ESC}[{top or ''};{bottom or ''}r", end="")
+    _write(f"{ESC}[{top or ''};{bottom or ''}r")
 
 
 def change_title(title: str):
-    print(f"{ESC}]0;{title}{ST}", end="")
+    _write(f"{ESC}]0;{title}{ST}")
 
 
 def use_alternate_screen_buffer():
-    print(f"{ESC}[?1049h", end="")
+    _write(ALTERNATE_SCREEN_BUFFER)
 
 
 def use_main_screen_buffer():
-    print(f"{ESC}[?1049l", end="")
+    _write(MAIN_SCREEN_BUFFER)
 
 
 def soft_reset():
-    print(f"{ESC}[!p", end="")
+    _write(SOFT_RESET)
 
 
 class EraseException(Exception):
@@ -252,12 +347,20 @@ def _erase_mode(from_cursor: bool, to_cursor: bool):
                 "At least one of from_cursor and to_cursor must be True")
 
 
+def erase_display_str(from_cursor: bool = True, to_cursor: bool = True):
+    return f"{ESC}[{_erase_mode(from_cursor, to_cursor)}J"
+
+
 def erase_display(from_cursor: bool = True, to_cursor: bool = True):
-    print(f"{ESC}[{_erase_mode(from_cursor, to_cursor)}J", end="")
+    _write(erase_display_str(from_cursor, to_cursor))
+
+
+def erase_line_str(from_cursor: bool = True, to_cursor: bool = True):
+    return f"{ESC}[{_erase_mode(from_cursor, to_cursor)}K"
 
 
 def erase_line(from_cursor: bool = True, to_cursor: bool = True):
-    print(f"{ESC}[{_erase_mode(from_cursor, to_cursor)}K", end="")
+    _write(erase_line_str(from_cursor, to_cursor))
 
 
 class Color(Enum):
@@ -284,6 +387,70 @@ class Color(Enum):
 
 FORMAT_RESET = f"{ESC}[0m"
 
+# SGR codes per color, already as strings, so format() doesn't need the enum attribute lookups or conversions
+_FG_CODES = {c: str(c.value) for c in Color}
+_BG_CODES = {c: str(40 + c.value) for c in Color}
+_BG_BRIGHT_CODES = {c: str(100 + c.value) for c in Color}
+# the whole escape sequence for format() with only fg_color
+_FG_SPECIFIERS = {c: f"{ESC}[{c.value}m" for c in Color}
+
+
+@functools.lru_cache(maxsize=256)
+def _format_specifier(italic: bool, underline: bool, negative: bool, hide: bool, strikethrough: bool, double_underline: bool, overline: bool, fg_color: Color | tuple[int, int, int] | None, fg_bright: bool, fg_dim: bool, bg_color: Color | tuple[int, int, int] | None, bg_bright: bool) -> str:
+    """ The escape sequence for format(), which only depends on the options and not the string, so it is cached. """
+    format_options: list[str] = []
+
+    if italic:
+        format_options.append("3")
+    if underline:
+        format_options.append("4")
+    if negative:
+        format_options.append("7")
+    if hide:
+        format_options.append("8")
+    if strikethrough:
+        format_options.append("9")
+    if double_underline:
+        format_options.append("21")
+    if overline:
+        format_options.append("53")
+
+    # Color cannot be subclassed since it has members, so the identity check is exact
+    if type(fg_color) is Color:
+        format_options.append(_FG_CODES[fg_color])
+    elif isinstance(fg_color, tuple):
+        if len(fg_color) != 3:
+            raise Exception("fg_color must be an RGB 3-tuple")
+        format_options.extend(("38", "2"))
+        format_options.extend(map(str, fg_color))
+    if fg_bright:
+        format_options.append("1")
+    if fg_dim:
+        format_options.append("2")
+
+    if type(bg_color) is Color:
+        format_options.append(
+            (_BG_BRIGHT_CODES if bg_bright else _BG_CODES)[bg_color])
+    elif isinstance(bg_color, tuple):
+        if len(bg_color) != 3:
+            raise Exception("bg_color must be an RGB 3-tuple")
+        format_options.extend(("48", "2"))
+        format_options.extend(map(str, bg_color))
+
+    if not format_options:
+        # no formatting
+        return ""
+
+    return f"{ESC}[{';'.join(format_options)}m"
+
+
+def _get_format_specifier(*options) -> str:
+    """ `_format_specifier`, skipping the cache for unhashable options such as list colors (which are ignored like any other non-tuple color). """
+    try:
+        return _format_specifier(*options)
+    except TypeError:
+        return _format_specifier.__wrapped__(*options)
+
 
 def format(s: str,
            # general options
@@ -308,7 +475,9 @@ def format(s: str,
 
     Specifying negative=True swaps the foreground and background colors. The only case where provides functionality otherwise not achievable (except by using custom colors) is dimming the background color.
 
-    Specifying reset=False will cause the formatting to persist on all output until different formatting is specified, or it is reset using print(FORMAT_RESET, end=""). """
+    Specifying reset=False will cause the formatting to persist on all output until different formatting is specified, or it is reset using print(FORMAT_RESET, end="").
+
+    If no formatting is specified, the string is returned unchanged, without a reset even if reset=True. """
     """
     for i in range(0, 128):
         print(f"{ESC}[{i}m{i:03}{ESC}[m")
@@ -332,49 +501,22 @@ def format(s: str,
     90-97 bold/bright fg, redundant with 1
     100-107 bold/bright bg """
 
-    format_options = []
-
-    if italic:
-        format_options.append(3)
-    if underline:
-        format_options.append(4)
-    if negative:
-        format_options.append(7)
-    if hide:
-        format_options.append(8)
-    if strikethrough:
-        format_options.append(9)
-    if double_underline:
-        format_options.append(21)
-    if overline:
-        format_options.append(53)
-
-    if isinstance(fg_color, Color):
-        format_options.append(str(fg_color.value))
-    elif isinstance(fg_color, tuple):
-        if len(fg_color) != 3:
-            raise Exception("fg_color must be an RGB 3-tuple")
-        format_options.extend((38, 2))
-        format_options.extend(fg_color)
-    if bold or fg_bright:
-        format_options.append(1)
-    if fg_dim:
-        format_options.append(2)
-
-    if isinstance(bg_color, Color):
-        format_options.append(40 + bg_color.value +
-                              (60 if bg_bright else 0))
-    elif isinstance(bg_color, tuple):
-        if len(bg_color) != 3:
-            raise Exception("bg_color must be an RGB 3-tuple")
-        format_options.extend((48, 2))
-        format_options.extend(bg_color)
-
-    if not format_options:
-        # no formatting
+    if bg_color is None and not (bold or italic or underline or negative or hide or strikethrough or double_underline or overline or fg_bright or fg_dim):
+        if fg_color is None:
+            # no formatting
+            return s
+        if type(fg_color) is Color:
+            # just a color, the most common case
+            format_specifier = _FG_SPECIFIERS[fg_color]
+        else:
+            format_specifier = _get_format_specifier(False, False, False, False, False,
+                                                     False, False, fg_color, False, False, None, False)
+    else:
+        format_specifier = _get_format_specifier(italic, underline, negative, hide, strikethrough,
+                                                 double_underline, overline, fg_color, bold or fg_bright, fg_dim, bg_color, bg_bright)
+    if not format_specifier:
         return s
 
-    format_specifier = f"{ESC}[" + \
-        ";".join((str(f) for f in format_options)) + "m"
-
-    return format_specifier + s + (FORMAT_RESET if reset else "")
+    if reset:
+        return format_specifier + s + FORMAT_RESET
+    return format_specifier + s
@@ -1,9 +1,32 @@
 # (c) Andrew Chen (https://github.com/achen1296)
 
+import functools
 import math
 import time
+from threading import Event, Thread
+from typing import Any, Iterable, Iterator
 
 from .ansi_escape import *
+from .ansi_escape import _write
+
+try:
+    from wcwidth import wcswidth
+except ModuleNotFoundError:
+    wcswidth = None
+
+# escape sequences that are the same for every Progress frame
+_ERASE_BELOW = erase_display_str(from_cursor=True, to_cursor=False)
+_LINE_START = cursor_horizontal_absolute_str(1)
+
+
+@functools.lru_cache(maxsize=64)
+def _cell_width(s: str) -> int:
+    """ How many terminal cells s takes up, e.g. 2 for many emoji. Counts characters if wcwidth is not installed or s has non-printable characters. """
+    if wcswidth is not None:
+        width = wcswidth(s)
+        if width >= 0:
+            return width
+    return len(s)
 
 
 class Spinner:
@@ -14,6 +37,8 @@ class Spinner:
     def __init__(self, *, min_update_time: float = 0.2, min_update_count=100, spinner_sequence="-\\|/"):
         self.last_update_time = None
         self.min_update_time = min_update_time
+        # last_update_time + min_update_time, stored to compare against directly
+        self._next_update_at = -math.inf
 
         self.updates = 0
         self.min_update_count = min_update_count
@@ -21,21 +46,24 @@ class Spinner:
         self.spinner_sequence = spinner_sequence
         self.sequence_index = 0
         self.sequence_length = len(self.spinner_sequence)
+        # complete output for each step of the sequence
+        self._frames = [cursor_back_str(1) + c for c in spinner_sequence]
 
     def spin(self):
-        self.updates += 1
-        if self.updates < self.min_update_count:
+        # the count is checked first so that most calls return without getting the time
+        updates = self.updates + 1
+        if updates < self.min_update_count:
+            self.updates = updates
             return
         self.updates = 0
         now = time.monotonic()
-        if self.last_update_time is not None and now < self.last_update_time + self.min_update_time:
+        if now < self._next_update_at:
             return
         self.last_update_time = now
-        cursor_back(1)
-        print(
-            self.spinner_sequence[self.sequence_index], end="", flush=True)
-        self.sequence_index = (
-            self.sequence_index+1) % self.sequence_length
+        self._next_update_at = now + self.min_update_time
+        index = self.sequence_index
+        _write(self._frames[index])
+        self.sequence_index = (index + 1) % self.sequence_length
 
     @staticmethod
     def clear():
@@ -68,6 +96,7 @@ class Progress:
                  percent_format: str | None = None,
 
                  min_update_time: float = 0.1,
+                 min_update_count: int = 1,
                  ):
         """ Leaving the format arguments as None will automatically:
         - For fraction numerator/denominator:
@@ -83,6 +112,8 @@ class Progress:
         Under the assumption that all progress values are between 0 and max inclusive, this should keep the text width consistent. Otherwise, it is up to the user to keep the width consistent.
 
         Nothing else should be printed from the moment of construction until it is no longer needed (presumably finishing with a clear() call). Use the comment parameter to add additional text below.
+
+        Like for Spinner, min_update_count can be increased to only check the time every so many updates, for very frequent updates.
         """
         self.max = max
         self.show_fraction = show_fraction
@@ -100,18 +131,49 @@ class Progress:
 
         self.min_update_time = min_update_time
         self.last_update_time = None
+        # last_update_time + min_update_time, stored to compare against directly
+        self._next_update_at = -math.inf
         self.last_progress = 0
 
-    def progress_text(self, value: int | float, comment: str | None):
-        prog_text = ""
+        self.updates = 0
+        self.min_update_count = min_update_count
+
+        # (time checked, columns), so the terminal is not queried on every update
+        self._terminal_width_cache = (None, 0)
+        # (comment, terminal width, comment up to its first newline, lines taken by the rest of the comment), so an unchanged comment is not measured again
+        self._comment_measure: tuple[str, int, str, int] | None = None
+
+        # the last output of _draw, to skip writing the same thing again
+        self._last_frame: str | None = None
+
+        # for start_async
+        self.counter: int | float = 0
+        self._shared_counter: Any = None
+        self._render_thread: Thread | None = None
+        self._render_stop = Event()
+
+    TERMINAL_WIDTH_TTL = 0.25
+
+    def _terminal_width(self) -> int:
+        checked, columns = self._terminal_width_cache
+        now = time.monotonic()
+        if checked is None or now >= checked + self.TERMINAL_WIDTH_TTL:
+            columns = get_terminal_size().columns
+            self._terminal_width_cache = (now, columns)
+        return columns
+
+    def _format_progress(self, value: int | float) -> str:
+        """ The fraction and/or percentage, reading the current attributes so that changes to them take effect. A single f-string for each combination of shown parts. """
         if self.show_fraction:
-            prog_text += f"{value:{self.numerator_format}}/{self.denominator}"
             if self.show_percent:
-                prog_text += " "
-
+                return f"{value:{self.numerator_format}}/{self.denominator} {value/self.max:{self.percent_format}}"
+            return f"{value:{self.numerator_format}}/{self.denominator}"
         if self.show_percent:
-            prog_text += f"{value/self.max:{self.percent_format}}"
+            return f"{value/self.max:{self.percent_format}}"
+        return ""
 
+    def progress_text(self, value: int | float, comment: str | None):
+        prog_text = self._format_progress(value)
         if comment:  # not None or ""
             prog_text += " "
         return prog_text
@@ -120,27 +182,119 @@ class Progress:
         """ Set and print the updated progress value. Comments are appended after the progress text (with a space in between). If the comment is not specified, any prior comments are not cleared (specify "") to clear comments. """
         self.last_progress = value
 
+        # the count is checked first so that most calls return without getting the time, but the first update is always shown
+        updates = self.updates + 1
+        if updates < self.min_update_count and self.last_update_time is not None:
+            self.updates = updates
+            return
+        self.updates = 0
         now = time.monotonic()
-        if self.last_update_time is not None and now < self.last_update_time + self.min_update_time:
+        if now < self._next_update_at:
             return
         self.last_update_time = now
+        self._next_update_at = now + self.min_update_time
+        self._draw(value, comment)
 
+    def _draw(self, value: int | float, comment: str | None):
         prog_text = self.progress_text(value, comment)
-        print(prog_text, end="", flush=True)
-
+        # write everything at once
+        frame = [prog_text]
         if comment is not None:
-            erase_display(from_cursor=True, to_cursor=False)
-            print(comment, end="", flush=True)
-        cursor_up(measure_lines(prog_text + (comment or ""))-1)
-        cursor_horizontal_absolute(1)
+            frame.append(_ERASE_BELOW)
+            frame.append(comment)
+        lines = self._measure(prog_text, comment)
+        if lines == 1:
+            # a carriage return is all that is needed to go back to the start
+            frame.append("\r")
+        else:
+            frame.append(cursor_up_str(lines-1))
+            frame.append(_LINE_START)
+        output = "".join(frame)
+        if output == self._last_frame:
+            # nothing visible would change
+            return
+        self._last_frame = output
+        _write(output)
+
+    def _measure(self, prog_text: str, comment: str | None) -> int:
+        """ measure_lines(prog_text + comment), but the part of the comment after its first newline does not depend on prog_text, so its measurement is kept while the comment stays the same. """
+        terminal_width = self._terminal_width()
+        if not comment:
+            return measure_lines(prog_text, terminal_width)
+        if self._comment_measure is None or self._comment_measure[0] != comment or self._comment_measure[1] != terminal_width:
+            head, newline, tail = comment.partition("\n")
+            self._comment_measure = (comment, terminal_width, head,
+                                     measure_lines(tail, terminal_width) if newline else 0)
+        _, _, head, tail_lines = self._comment_measure
+        return measure_lines(prog_text + head, terminal_width) + tail_lines
 
     def increase_progress(self, value: int | float, comment: str | None = None):
+        """ Add value to the progress. Calls that are rate limited only add to last_progress, so in tight loops, increase min_update_count to also skip getting the time for most calls. """
         self.update_progress(self.last_progress + value, comment)
 
+    def wrap[T](self, iterable: Iterable[T]) -> Iterator[T]:
+        """ Yield the items of iterable, increasing the progress by 1 for each one. Only the time is checked per item (ignoring min_update_count), and the final progress is always drawn at the end. """
+        value = self.last_progress
+        monotonic = time.monotonic
+        min_update_time = self.min_update_time
+        next_update = monotonic()
+        for item in iterable:
+            now = monotonic()
+            if now >= next_update:
+                next_update = now + min_update_time
+                self.last_update_time = now
+                self._next_update_at = next_update
+                self._draw(value, None)
+            yield item
+            value += 1
+            self.last_progress = value
+        self._draw(value, None)
+
+    def start_async(self, shared_counter: Any = None):
+        """ Draw the progress from a background thread every min_update_time seconds, so that the loop doing the work only has to call inc() (or change counter directly). Call stop() when finished, before clear().
+
+        shared_counter can instead be a one-element array (e.g. numpy.zeros(1, dtype=numpy.uint64)) whose first element is the progress. The work can then be done where Python methods cannot be called, e.g. a numba @njit(nogil=True) loop that does `shared_counter[0] += 1`. """
+        if self._render_thread is not None:
+            return
+        self.counter = self.last_progress
+        self._shared_counter = shared_counter
+        self._render_stop.clear()
+        self._render_thread = Thread(target=self._render_loop, daemon=True)
+        self._render_thread.start()
+
+    def inc(self, value: int | float = 1):
+        """ Increase the progress for start_async. """
+        self.counter += value
+
+    def _read_counter(self) -> int | float:
+        if self._shared_counter is None:
+            return self.counter
+        return self._shared_counter[0]
+
+    def _render_loop(self):
+        last_drawn = None
+        while not self._render_stop.wait(self.min_update_time):
+            value = self._read_counter()
+            if value != last_drawn:
+                self._draw(value, None)
+                last_drawn = value
+
+    def stop(self):
+        """ Stop the thread from start_async and draw the final progress. """
+        if self._render_thread is None:
+            return
+        self._render_stop.set()
+        self._render_thread.join()
+        self._render_thread = None
+        self.counter = self.last_progress = self._read_counter()
+        self._shared_counter = None
+        self._draw(self.counter, None)
+
     def clear(self):
         """ Clear the progress display (usually when finished). """
         # assumes cursor just reset at end of update_progress
         erase_display(from_cursor=True, to_cursor=False)
+        self._last_frame = None
 
 
 class ProgressBar(Progress):
@@ -149,32 +303,105 @@ class ProgressBar(Progress):
     def __init__(self, max: int | float, *, left: str = "|", right: str = "|", incomplete: str = " ", complete: str = "\u2588", width: int | None = None, **progress_kwargs):
         """ left and right: bar boundary characters
         incomplete: the initial character the bar is filled with
-        complete: the character the bar is replaced with as progress increases
-        width: the width that ALL of the characters, including the progress text and the bar, may take up; leave as None to adapt to the current terminal width on each update (via get_terminal_size) """
+        complete: the character the bar is replaced with as progress increases, a full block (\u2588) by default; pass an ASCII character such as "#" for output that cannot show it
+        width: the width in terminal cells that ALL of the characters, including the progress text and the bar, may take up (wide characters are measured with wcwidth if it is installed); leave as None to adapt to the current terminal width (via get_terminal_size, checked at most every TERMINAL_WIDTH_TTL seconds) """
         super().__init__(max=max, **progress_kwargs)
         self.left = left
         self.right = right
         self.incomplete = incomplete
         self.complete = complete
         self.width = width
-
-    def progress_text(self, value: int | float, comment: str | None = None):
-        """ Append the progress bar onto the normal progress text and push comments onto the next line. """
+        # (complete, incomplete, count, complete run, incomplete run), repeated bar characters to slice from
+        self._bar_runs = ("", "", 0, "", "")
+        # (progress text, bar width, complete characters) from the last call to progress_text
+        self._last_layout: tuple[str, int, int] = ("", 0, 0)
+        # what the bar on the screen looks like, (progress text, bar width, complete characters, left, right, complete, incomplete, terminal width), or None if _draw cannot update only the changed part
+        self._drawn_bar: tuple[str, int, int, str, str, str, str, int] | None = None
+
+    def _runs(self, count: int) -> tuple[str, str]:
+        """ Strings of at least count complete and incomplete characters, so that the bar can be sliced from them instead of built up. """
+        complete, incomplete, run_count, complete_run, incomplete_run = self._bar_runs
+        if complete != self.complete or incomplete != self.incomplete or run_count < count:
+            complete_run = self.complete * count
+            incomplete_run = self.incomplete * count
+            self._bar_runs = (self.complete, self.incomplete, count,
+                              complete_run, incomplete_run)
+        return complete_run, incomplete_run
+
+    def _layout(self, value: int | float, comment: str | None) -> tuple[str, int, int, int]:
+        """ The progress text (with a space at the end), the bar width in cells (excluding left and right), and the number of complete and incomplete characters in the bar. """
         prog_text = super().progress_text(value, comment)
         if not prog_text.endswith(" "):
             prog_text += " "
 
-        total_width = self.width or get_terminal_size().columns
+        max_ = self.max
+
+        total_width = self.width or self._terminal_width()
         bar_width = total_width - \
-            (len(prog_text) + len(self.left) + len(self.right))
+            (len(prog_text) + _cell_width(self.left) + _cell_width(self.right))
+
+        if isinstance(value, int) and isinstance(max_, int):
+            # same rounding without going through floats
+            complete_cells = (2 * value * bar_width + max_) // (2 * max_)
+        else:
+            complete_cells = math.floor((value/max_) * bar_width + 0.5)
+        # wide characters fill more than one cell each, "or 1" for empty strings
+        complete_width = _cell_width(self.complete) or 1
+        complete_chars = complete_cells // complete_width
+        incomplete_chars = (bar_width - complete_chars * complete_width) // \
+            (_cell_width(self.incomplete) or 1)
+        return prog_text, bar_width, complete_chars, incomplete_chars
+
+    def progress_text(self, value: int | float, comment: str | None = None):
+        """ Append the progress bar onto the normal progress text and push comments onto the next line. """
+        prog_text, bar_width, complete_chars, incomplete_chars = self._layout(
+            value, comment)
+        self._last_layout = (prog_text, bar_width, complete_chars)
 
-        complete_chars = math.floor((value/self.max) * bar_width + 0.5)
-        incomplete_chars = bar_width - complete_chars
-        bar = self.left + (self.complete * complete_chars) + \
-            (self.incomplete * incomplete_chars) + self.right
+        complete_run, incomplete_run = self._runs(
+            max(complete_chars, incomplete_chars))
+        # clamp because slicing with a negative count would not be empty like multiplying is
+        bar = f"{self.left}{complete_run[:max(complete_chars, 0) * len(self.complete)]}{incomplete_run[:max(incomplete_chars, 0) * len(self.incomplete)]}{self.right}"
 
         # push the comment onto the next line
         if comment and not comment.startswith("\n"):
             bar += "\n"
 
         return prog_text + bar
+
+    def _draw(self, value: int | float, comment: str | None):
+        # when the bar only grew, write the new progress text and only the newly complete characters, skipping over the rest of the bar
+        drawn = self._drawn_bar
+        if comment is None and drawn is not None and drawn[3:] == (self.left, self.right, self.complete, self.incomplete, self._terminal_width()):
+            drawn_prog_text, drawn_bar_width, drawn_complete_chars = drawn[:3]
+            prog_text, bar_width, complete_chars, incomplete_chars = self._layout(
+                value, None)
+            if bar_width == drawn_bar_width and len(prog_text) == len(drawn_prog_text) and drawn_complete_chars <= complete_chars and incomplete_chars >= 0:
+                if complete_chars == drawn_complete_chars:
+                    if prog_text == drawn_prog_text:
+                        return
+                    output = prog_text + "\r"
+                else:
+                    output = f"{prog_text}{self.left}{cursor_forward_str(drawn_complete_chars * _cell_width(self.complete))}{self.complete * (complete_chars - drawn_complete_chars)}\r"
+                _write(output)
+                self._drawn_bar = (prog_text, bar_width,
+                                   complete_chars) + drawn[3:]
+                # the screen no longer matches the last full frame
+                self._last_frame = None
+                return
+
+        super()._draw(value, comment)
+        prog_text, bar_width, complete_chars = self._last_layout
+        terminal_width = self._terminal_width()
+        complete_width = _cell_width(self.complete)
+        # the bar must be on one line by itself, and complete characters must exactly cover incomplete ones
+        # after a comment, the erase right after a bar that fills the line can take the last character with it, so that needs a full redraw first
+        if comment is None and (self.width or terminal_width) <= terminal_width and complete_width == _cell_width(self.incomplete) > 0 and 0 <= complete_chars <= bar_width // complete_width:
+            self._drawn_bar = (prog_text, bar_width, complete_chars, self.left,
+                               self.right, self.complete, self.incomplete, terminal_width)
+        else:
+            self._drawn_bar = None
+
+    def clear(self):
+        super().clear()
+        self._drawn_bar = None
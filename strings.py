@@ -1,5 +1,6 @@
 # (c) Andrew Chen (https://github.com/achen1296)
 
+import functools
 import re
 from io import StringIO
 from typing import Iterable, Sequence
@@ -12,27 +13,26 @@ def unescape(s: str, *, escape_char: str = "\\") -> str:
     """Removes one level of escape characters. Only supports single characters."""
     if len(escape_char) != 1:
         raise Exception("Only single characters allowed")
-    i = 0
-    while i < len(s):
-        if s[i] == escape_char:
-            s = s[:i] + s[i+1:]
-        # if there was an escape \, this skips over the character after it, in case it is an escaped \ i.e. \\, so only the first one is removed
-        i += 1
-    return s
+    if escape_char not in s:
+        return s
+    # one pass building a list, instead of slicing the string around each escape
+    result = []
+    chars = iter(s)
+    for c in chars:
+        if c == escape_char:
+            # keep the character after it, in case it is an escaped \ i.e. \\, so only the first one is removed (a trailing escape is just removed)
+            c = next(chars, "")
+        result.append(c)
+    return "".join(result)
 
 
 def escape(s: str, special_chars: Iterable[str], *, escape_char: str = "\\") -> str:
     """Adds one level of escape characters. Only supports single characters."""
+    special_chars = set(special_chars)
     for c in special_chars:
         if len(c) != 1:
             raise Exception("Only single characters allowed")
-    i = 0
-    while i < len(s):
-        if s[i] in special_chars:
-            s = s[:i]+escape_char+s[i:]
-            i += 1
-        i += 1
-    return s
+    return "".join(escape_char + c if c in special_chars else c for c in s)
 
 
 def argument_split(s: str, sep: str = "\\s+", *, remove_outer: dict[str, str] = {'"': '"', "'": "'"}, remove_empty_args=True, unescape_char: str | None = "\\", re_flags: int = 0, split_compounds: bool = True, **find_pairs_kwargs) -> list[str]:
@@ -42,19 +42,23 @@ def argument_split(s: str, sep: str = "\\s+", *, remove_outer: dict[str, str] =
 
     found_pairs = find_pairs(s, **find_pairs_kwargs)
 
-    def in_any_pair(span: tuple[int, int]):
-        # only outermost pairs matter
-        for p in found_pairs:
-            if span_include_inclusive(p.span, span):
-                return True
-        return False
+    # only outermost pairs matter, and since pairs nest, those do not overlap each other
+    outer_spans: list[tuple[int, int]] = []
+    for sp in sorted(p.span for p in found_pairs):
+        if not outer_spans or sp[0] >= outer_spans[-1][1]:
+            outer_spans.append(sp)
 
     # indices at which to slice, so every two indices are a span to include
     slices: list[int] = [0]
 
+    # separator matches come in order, so a single pass over the outer pairs alongside them finds the ones inside a pair
+    outer_iter = iter(outer_spans)
+    outer = next(outer_iter, None)
     for m in re.finditer(sep, s, re_flags):
         sp = m.span()
-        if not in_any_pair(sp):
+        while outer is not None and outer[1] < sp[1]:
+            outer = next(outer_iter, None)
+        if outer is None or not span_include_inclusive(outer, sp):
             slices.extend(sp)
 
     len_s = len(s)
@@ -75,12 +79,13 @@ def argument_split(s: str, sep: str = "\\s+", *, remove_outer: dict[str, str] =
             # appended some for adjacent pairs
             slices.sort()
 
-    args = [s[slices[i]:slices[i+1]] for i in range(0, len(slices), 2)]
-    if unescape_char != None:
-        args = [unescape(t, escape_char=unescape_char) for t in args]
-    if remove_outer:
-        new_args = []
-        for t in args:
+    # each argument goes through unescaping, outer pair removal and the empty check in turn, rather than building a new list for each step
+    args = []
+    for i in range(0, len(slices), 2):
+        t = s[slices[i]:slices[i+1]]
+        if unescape_char != None:
+            t = unescape(t, escape_char=unescape_char)
+        if remove_outer:
             for o in remove_outer:
                 m = re.match(o, t)
                 if m != None:
@@ -95,10 +100,8 @@ def argument_split(s: str, sep: str = "\\s+", *, remove_outer: dict[str, str] =
                     t = t[:m.start()]
                     # only remove one outer pair
                     break
-            new_args.append(t)
-        args = new_args
-    if remove_empty_args:
-        args = [t for t in args if t != ""]
+        if not remove_empty_args or t != "":
+            args.append(t)
     return args
 
 
@@ -295,6 +298,11 @@ def find_pair(s: str, start: int, **find_pairs_kwargs):
         f"Didn't find a pair beginning at index {start} of {s}")
 
 
+@functools.lru_cache(maxsize=32)
+def _special_chars_re(chars: frozenset[str]) -> re.Pattern:
+    return re.compile("[" + "".join(map(re.escape, sorted(chars))) + "]")
+
+
 def find_pairs(s: str, *, pairs: dict[str, str] | None = None, ignore_internal_pairs: Iterable[str] | None = None, require_balanced_pairs=True, escape: str | None = "\\") -> list[Pair]:
     """ Only supports pairs that start and end with single characters, but which can handle escape characters (also limited to a single character) as a result. """
     if pairs is None:
@@ -309,20 +317,29 @@ def find_pairs(s: str, *, pairs: dict[str, str] | None = None, ignore_internal_p
     pair_list_stack: list[list[Pair]] = [[]]
     # stack of pair starts
     start_stack = []
+    # the end character for each start, so it is not looked up again for every character
+    end_stack = []
     ignoring_internal = False
-    i = -1
-    while True:
-        i += 1
-        if i >= len(s):
-            break
-
-        c = s[i]
-        if escape and c == escape:
-            i += 1
+    # only characters that can start or end a pair or escape need to be looked at, the regex finds those without going through every character
+    special = {c for c in (*pairs, *pairs.values()) if len(c) == 1}
+    if escape is not None and len(escape) == 1:
+        special.add(escape)
+    if not special:
+        return []
+    # an escape skips the next character
+    escaped_index = -1
+    for m in _special_chars_re(frozenset(special)).finditer(s):
+        i = m.start()
+        if i == escaped_index:
+            continue
+        c = m.group()
+        if c == escape:
+            escaped_index = i + 1
             continue
 
-        if start_stack and c == pairs[s[start_stack[-1]]]:
+        if end_stack and c == end_stack[-1]:
             start_index = start_stack.pop()
+            end_stack.pop()
             if not ignoring_internal and len(pair_list_stack) > 1:
                 internal_pairs = pair_list_stack.pop()
             else:
@@ -333,6 +350,7 @@ def find_pairs(s: str, *, pairs: dict[str, str] | None = None, ignore_internal_p
             ignoring_internal = False
         elif not ignoring_internal and c in pairs:
             start_stack.append(i)
+            end_stack.append(pairs[c])
             if c in ignore_internal_pairs:
                 ignoring_internal = True
             else: